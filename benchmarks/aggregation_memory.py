@@ -0,0 +1,64 @@
+"""
+Benchmark the peak memory use of the area aggregation for different memory
+budgets. The aggregation covers the extent of a parsed raster layer.
+
+Run from the repository root with a configured database:
+
+    DJANGO_SETTINGS_MODULE=settings python -m benchmarks.aggregation_memory <rasterlayer id> [zoom]
+"""
+import multiprocessing
+import resource
+import sys
+import time
+
+import django
+from django.contrib.gis.geos import Polygon
+from django.db import connection
+
+MEGABYTE = 1024 * 1024
+
+
+def aggregate(queue, layer_id, zoom, memory_budget):
+    """
+    Compute the value counts over the extent of the raster layer and report
+    the timing and the peak memory use of the process.
+    """
+    from raster.models import RasterLayer
+    from raster_aggregation.utils import WEB_MERCATOR_SRID
+    from raster_aggregation.valuecount import AreaAggregator
+
+    layer = RasterLayer.objects.get(id=layer_id)
+    geom = Polygon.from_bbox(layer.extent())
+    geom.srid = WEB_MERCATOR_SRID
+
+    start = time.time()
+    agg = AreaAggregator(geom, {'a': str(layer_id)}, 'a', zoom=zoom, grouping='discrete', memory_budget=memory_budget)
+    agg.value_count()
+    duration = time.time() - start
+
+    # The maximum resident set size is reported in kilobytes on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    queue.put((agg.batch_size, duration, peak))
+
+
+def run(layer_id, zoom=None, budgets=(16, 64, 256, 1024)):
+    from raster_aggregation.valuecount import MEMORY_BUDGET
+
+    print('Configured memory budget: {0:.0f} MB'.format(MEMORY_BUDGET / MEGABYTE))
+    print('{0:>12} {1:>12} {2:>12} {3:>14}'.format('budget (MB)', 'batch size', 'time (s)', 'peak RSS (MB)'))
+
+    for budget in budgets:
+        # Run each budget in a separate process to measure its peak memory
+        connection.close()
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=aggregate, args=(queue, layer_id, zoom, budget * MEGABYTE))
+        process.start()
+        batch_size, duration, peak = queue.get()
+        process.join()
+
+        print('{0:>12} {1:>12} {2:>12.3f} {3:>14.1f}'.format(budget, batch_size, duration, peak / MEGABYTE))
+
+
+if __name__ == '__main__':
+    django.setup()
+    run(int(sys.argv[1]), int(sys.argv[2]) if len(sys.argv) > 2 else None)
@@ -0,0 +1,50 @@
+"""
+Benchmark the in-process geometry repair against the PostGIS repair.
+
+Run from the repository root with a configured database:
+
+    DJANGO_SETTINGS_MODULE=settings python -m benchmarks.geometry_repair
+"""
+import math
+import time
+
+import django
+from django.contrib.gis.geos import Polygon
+from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygon_sql, convert_to_multipolygons, shapely
+
+
+def star_polygon(nr_of_vertices, radius=1000, offset=0):
+    """
+    Create a self intersecting star shaped polygon.
+    """
+    coords = []
+    for i in range(nr_of_vertices):
+        angle = 2 * math.pi * ((i * 3) % nr_of_vertices) / nr_of_vertices
+        coords.append((offset + radius * math.cos(angle), radius * math.sin(angle)))
+    coords.append(coords[0])
+    return Polygon(coords, srid=WEB_MERCATOR_SRID)
+
+
+def run(nr_of_geoms=200, nr_of_vertices=(10, 1000, 10000)):
+    print('{0:>10} {1:>10} {2:>12} {3:>12}'.format('geoms', 'vertices', 'sql (s)', 'in process (s)'))
+
+    for vertices in nr_of_vertices:
+        geoms = [star_polygon(vertices, offset=i * 3000) for i in range(nr_of_geoms)]
+
+        start = time.time()
+        for geom in geoms:
+            convert_to_multipolygon_sql(geom)
+        sql_time = time.time() - start
+
+        start = time.time()
+        convert_to_multipolygons(geoms)
+        batch_time = time.time() - start
+
+        print('{0:>10} {1:>10} {2:>12.3f} {3:>12.3f}'.format(nr_of_geoms, vertices, sql_time, batch_time))
+
+
+if __name__ == '__main__':
+    django.setup()
+    if shapely is None:
+        print('Shapely is not installed, the in process repair falls back to the sql repair.')
+    run()
@@ -5,8 +5,10 @@ from django.contrib import admin, messages
 from django.http import HttpResponseRedirect
 from django.shortcuts import render
 
-from .models import AggregationArea, AggregationLayer, ValueCountResult
-from .tasks import aggregation_layer_parser, compute_value_count_for_aggregation_layer
+from .models import AggregationArea, AggregationLayer, AggregationLayerLogEntry, ValueCountJob, ValueCountResult
+from .tasks import (
+    aggregation_layer_parallel_parser, aggregation_layer_parser, compute_value_count_for_aggregation_layer
+)
 
 
 class ValueCountResultAdmin(admin.ModelAdmin):
@@ -16,6 +18,21 @@ class ValueCountResultAdmin(admin.ModelAdmin):
     )
 
 
+class AggregationLayerLogEntryAdmin(admin.ModelAdmin):
+    list_display = ('aggregationlayer', 'level', 'fid', 'area_id', 'created', 'message')
+    list_filter = ('aggregationlayer', 'level')
+    readonly_fields = ('aggregationlayer', 'level', 'message', 'fid', 'area_id', 'created')
+
+
+class ValueCountJobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'aggregationlayer', 'status', 'total', 'done', 'failed', 'throughput', 'eta', 'started')
+    list_filter = ('aggregationlayer', 'status')
+    readonly_fields = (
+        'aggregationlayer', 'formula', 'layer_names', 'zoom', 'units', 'grouping',
+        'status', 'total', 'done', 'failed', 'throughput', 'eta', 'started', 'finished',
+    )
+
+
 class SelectLayerActionForm(forms.Form):
     """
     Form for selecting the raster-layer on which to compute value counts.
@@ -28,7 +45,7 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
 
     readonly_fields = ['modified']
 
-    actions = ['parse_shapefile_data', 'compute_value_count', ]
+    actions = ['parse_shapefile_data', 'parse_shapefile_data_in_parallel', 'compute_value_count', ]
 
     def parse_shapefile_data(self, request, queryset):
         if queryset.count() > 1:
@@ -43,6 +60,13 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
             self.message_user(request,
                 "Parsing shapefile asynchronously, please check the collection parse log for status")
 
+    def parse_shapefile_data_in_parallel(self, request, queryset):
+        for collection in queryset:
+            aggregation_layer_parallel_parser.delay(collection.id)
+
+        self.message_user(request,
+            "Parsing shapefiles in parallel chunks, please check the collection parse log for status")
+
     def compute_value_count(self, request, queryset):
 
         form = None
@@ -57,7 +81,7 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
 
                 for rst in rasterlayers:
                     compute_value_count_for_aggregation_layer.delay(
-                        layer,
+                        layer.id,
                         rst.id,
                         compute_area=True
                     )
@@ -65,7 +89,7 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
                 self.message_user(
                     request,
                     "Started Value Count on \"{agg}\" with {count} rasters. "
-                    "Check parse log for results.".format(agg=layer, count=rasterlayers.count())
+                    "Check the value count jobs for progress.".format(agg=layer, count=rasterlayers.count())
                 )
                 return HttpResponseRedirect(request.get_full_path())
 
@@ -88,3 +112,5 @@ class ComputeActivityAggregatesModelAdmin(admin.ModelAdmin):
 admin.site.register(AggregationArea)
 admin.site.register(ValueCountResult, ValueCountResultAdmin)
 admin.site.register(AggregationLayer, ComputeActivityAggregatesModelAdmin)
+admin.site.register(AggregationLayerLogEntry, AggregationLayerLogEntryAdmin)
+admin.site.register(ValueCountJob, ValueCountJobAdmin)
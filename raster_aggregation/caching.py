@@ -0,0 +1,180 @@
+import hashlib
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db.models import Count, Max
+
+# The generation counters are kept in the cache. They are only reliable if
+# the cache is shared by all web and worker processes, which is assumed
+# unless the cache is a dummy or a process local cache. Set to True or False
+# to override the detection. Etags are disabled if the generations are not
+# reliable, cached responses of a process local cache can be outdated until
+# they expire.
+GENERATION_COUNTERS = getattr(settings, 'RASTER_AGGREGATION_GENERATION_COUNTERS', None)
+
+# Derive the generations from the database instead of the counters, for
+# reliable etags without a shared cache. This runs aggregate queries over
+# the areas of the requested layer, or over all areas and value count
+# results, on every request including cache hits and conditional requests.
+DATABASE_GENERATIONS = getattr(settings, 'RASTER_AGGREGATION_DATABASE_GENERATIONS', False)
+
+# Cache key template of the generation counters.
+GENERATION_KEY = 'raster_aggregation_generation_{0}'
+
+# Generation of all aggregation layers, used for requests that are not
+# limited to a single aggregation layer.
+AREAS_GENERATION = 'areas'
+
+# Generation of the value count results.
+RESULTS_GENERATION = 'results'
+
+
+# Generation name template of single aggregation layers.
+LAYER_GENERATION = 'layer_{0}'
+
+
+def get_layer_generation_name(agglayer_id):
+    """
+    Get the generation counter name of an aggregation layer.
+    """
+    return LAYER_GENERATION.format(agglayer_id)
+
+
+def use_generation_counters(counters=GENERATION_COUNTERS):
+    """
+    Check if the generation counters in the cache are shared by all
+    processes.
+    """
+    if counters is not None:
+        return counters
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (DummyCache, LocMemCache))
+
+
+def generations_are_reliable(counters=GENERATION_COUNTERS, database=DATABASE_GENERATIONS):
+    """
+    Check if the generations change in all processes when the data changes.
+    """
+    return database or use_generation_counters(counters)
+
+
+def get_database_generation(name):
+    """
+    Derive a generation from the modification dates and the number of rows
+    of the data that it depends on. Unlike the counters, this requires
+    aggregate database queries.
+    """
+    AggregationLayer = apps.get_model('raster_aggregation', 'AggregationLayer')
+    AggregationArea = apps.get_model('raster_aggregation', 'AggregationArea')
+    ValueCountResult = apps.get_model('raster_aggregation', 'ValueCountResult')
+
+    if name == RESULTS_GENERATION:
+        state = ValueCountResult.objects.aggregate(results_modified=Max('created'), results=Count('id'))
+    else:
+        layers = AggregationLayer.objects.all()
+        areas = AggregationArea.objects.all()
+        agglayer_id = name[len(LAYER_GENERATION.format('')):] if name != AREAS_GENERATION else ''
+        if agglayer_id.isdigit():
+            layers = layers.filter(id=agglayer_id)
+            areas = areas.filter(aggregationlayer_id=agglayer_id)
+        state = layers.aggregate(layers_modified=Max('modified'), layers=Count('id'))
+        state.update(areas.aggregate(areas_modified=Max('modified'), areas=Count('id')))
+
+    return '|'.join('{0}={1}'.format(key, state[key]) for key in sorted(state))
+
+
+def get_initial_generation():
+    """
+    Initial value of generation counters. Counters start from the current
+    time, so that they do not repeat earlier values after being evicted from
+    the cache.
+    """
+    return int(time.time() * 1000)
+
+
+def get_generations(names):
+    """
+    Get the values of a list of generation counters in a single cache
+    request. The values are derived from the database if database
+    generations are enabled.
+    """
+    if DATABASE_GENERATIONS:
+        return [get_database_generation(name) for name in names]
+
+    keys = [GENERATION_KEY.format(name) for name in names]
+    values = cache.get_many(keys)
+    for key in keys:
+        if key not in values:
+            cache.add(key, get_initial_generation(), None)
+            values[key] = cache.get(key)
+    return [values[key] for key in keys]
+
+
+def bump_generations(names):
+    """
+    Increment a list of generation counters, invalidating all cache keys that
+    were built from them.
+    """
+    if DATABASE_GENERATIONS:
+        return
+    for name in names:
+        key = GENERATION_KEY.format(name)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, get_initial_generation(), None)
+
+
+def bump_layer_generation(agglayer_id):
+    """
+    Invalidate the cached responses for an aggregation layer.
+    """
+    bump_generations([get_layer_generation_name(agglayer_id), AREAS_GENERATION])
+
+
+def normalize_query(query):
+    """
+    Normalize request query parameters into a string that does not depend
+    on the order of the parameters, comma separated ids or layers, or on
+    whitespace in formulas.
+    """
+    items = []
+    for key, values in sorted(query.lists()):
+        if key in ('ids', 'layers'):
+            values = [','.join(sorted(value.split(','))) for value in values]
+        elif key == 'formula':
+            values = [value.replace(' ', '') for value in values]
+        items.append('{0}={1}'.format(key, ','.join(values)))
+    return '&'.join(items)
+
+
+def calculate_cache_key(prefix, view_method, request, extra=(), generations=()):
+    """
+    Build a response cache key from the view method, the url keyword
+    arguments, the normalized query parameters and generation counters. The
+    counters of the requested aggregation layer are included, or the global
+    counter if the request is not limited to one layer. Building the key
+    does not require a database query if the generation counters are used.
+    """
+    agglayer_id = request.GET.get('aggregationlayer')
+    names = [get_layer_generation_name(agglayer_id) if agglayer_id else AREAS_GENERATION] + list(generations)
+
+    cache_key_data = [view_method.__name__, normalize_query(request.GET)]
+    cache_key_data.extend(str(item) for item in extra)
+    cache_key_data.extend(str(generation) for generation in get_generations(names))
+
+    return '{0}_{1}'.format(prefix, hashlib.md5('|'.join(cache_key_data).encode()).hexdigest())
+
+
+def calculate_etag(prefix, view_method, request, extra=(), generations=()):
+    """
+    Build an etag from the same data as the response cache key. Returns None
+    if the generations are not reliable, which disables the etag, as clients
+    would otherwise keep receiving not modified responses for changed data.
+    """
+    if not generations_are_reliable():
+        return
+    return calculate_cache_key(prefix, view_method, request, extra, generations)
@@ -0,0 +1,6 @@
+class AggregationLayerParseError(Exception):
+    """
+    Raised when an aggregation layer can not be parsed. The message is
+    written to the parse log of the layer.
+    """
+    pass
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0010_valuecountresult_created'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregationLayerLogEntry',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('level', models.CharField(default='info', max_length=10, choices=[('debug', 'Debug'), ('info', 'Info'), ('warning', 'Warning'), ('error', 'Error')])),
+                ('message', models.TextField()),
+                ('fid', models.IntegerField(null=True, blank=True)),
+                ('area_id', models.IntegerField(null=True, blank=True)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('aggregationlayer', models.ForeignKey(to='raster_aggregation.AggregationLayer')),
+            ],
+            options={
+                'ordering': ('id',),
+            },
+        ),
+    ]
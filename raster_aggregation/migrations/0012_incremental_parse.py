@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0011_aggregationlayerlogentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aggregationarea',
+            name='geom_hash',
+            field=models.CharField(max_length=32, null=True, blank=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='aggregationarea',
+            name='modified',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='aggregationlayer',
+            name='shapefile_checksum',
+            field=models.CharField(max_length=32, null=True, blank=True),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0012_incremental_parse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregationLayerLabelMask',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('tilez', models.PositiveSmallIntegerField()),
+                ('tilex', models.IntegerField()),
+                ('tiley', models.IntegerField()),
+                ('labels', models.BinaryField()),
+                ('label_sets', models.TextField()),
+                ('layer_modified', models.DateTimeField()),
+                ('aggregationlayer', models.ForeignKey(to='raster_aggregation.AggregationLayer')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='aggregationlayerlabelmask',
+            unique_together=set([('aggregationlayer', 'tilez', 'tilex', 'tiley')]),
+        ),
+    ]
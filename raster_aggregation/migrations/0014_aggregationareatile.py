@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0013_aggregationlayerlabelmask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregationAreaTile',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('zoom', models.PositiveSmallIntegerField()),
+                ('tilez', models.PositiveSmallIntegerField()),
+                ('tilex', models.IntegerField()),
+                ('tiley', models.IntegerField()),
+                ('fully_covered', models.BooleanField(default=False)),
+                ('aggregationarea', models.ForeignKey(to='raster_aggregation.AggregationArea')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='aggregationareatile',
+            index_together=set([('aggregationarea', 'zoom')]),
+        ),
+    ]
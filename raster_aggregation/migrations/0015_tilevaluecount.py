@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.hstore
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0014_aggregationareatile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TileValueCount',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('digest', models.CharField(max_length=32)),
+                ('layer_names', django.contrib.postgres.fields.hstore.HStoreField()),
+                ('tilez', models.PositiveSmallIntegerField()),
+                ('tilex', models.IntegerField()),
+                ('tiley', models.IntegerField()),
+                ('value', django.contrib.postgres.fields.hstore.HStoreField()),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='tilevaluecount',
+            unique_together=set([('digest', 'tilez', 'tilex', 'tiley')]),
+        ),
+    ]
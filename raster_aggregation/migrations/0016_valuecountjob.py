@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.hstore
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0015_tilevaluecount'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ValueCountJob',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('formula', models.TextField()),
+                ('layer_names', django.contrib.postgres.fields.hstore.HStoreField()),
+                ('zoom', models.PositiveSmallIntegerField()),
+                ('units', models.TextField(default='')),
+                ('grouping', models.TextField(default='auto')),
+                ('status', models.CharField(default='running', max_length=10, choices=[
+                    ('running', 'Running'), ('finished', 'Finished'), ('failed', 'Failed')
+                ])),
+                ('total', models.IntegerField(default=0)),
+                ('done', models.IntegerField(default=0)),
+                ('failed', models.IntegerField(default=0)),
+                ('started', models.DateTimeField(default=django.utils.timezone.now)),
+                ('finished', models.DateTimeField(null=True, blank=True)),
+                ('aggregationlayer', models.ForeignKey(to='raster_aggregation.AggregationLayer')),
+            ],
+            options={
+                'ordering': ('-id',),
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('raster_aggregation', '0016_valuecountjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AggregationAreaSimplification',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('min_zoom', models.PositiveSmallIntegerField()),
+                ('max_zoom', models.PositiveSmallIntegerField()),
+                ('geom', django.contrib.gis.db.models.fields.MultiPolygonField(srid=3857)),
+                ('aggregationarea', models.ForeignKey(to='raster_aggregation.AggregationArea')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='aggregationareasimplification',
+            index_together=set([('aggregationarea', 'min_zoom', 'max_zoom')]),
+        ),
+    ]
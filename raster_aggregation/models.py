@@ -1,14 +1,84 @@
-import datetime
+import hashlib
+import json
 
 from raster.models import Legend, RasterLayer
 from raster.tiles.parser import rasterlayers_parser_ended
+from raster.tiles.utils import tile_bounds, tile_index_range, tile_scale
 from raster.valuecount import Aggregator
 
+from django.conf import settings
 from django.contrib.gis.db import models
+from django.contrib.gis.db.models import Extent
 from django.contrib.postgres.fields import HStoreField
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygon
+from django.utils import timezone
+from raster_aggregation.caching import RESULTS_GENERATION, bump_generations, bump_layer_generation
+from raster_aggregation.tilecache import tile_cache
+from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygon, geometry_hash
+from raster_aggregation.valuecount import (
+    AreaAggregator, LayerAggregator, build_label_masks, encode_labels, expand_tile_coverage, get_tile_coverage,
+    get_tile_coverage_blocks
+)
+
+# Number of log entries that are buffered before writing them to the database.
+LOG_BUFFER_SIZE = getattr(settings, 'RASTER_AGGREGATION_LOG_BUFFER_SIZE', 500)
+
+# Maximum number of feature or area specific entries rendered in the parse log.
+PARSE_LOG_MAX_ITEM_ENTRIES = getattr(settings, 'RASTER_AGGREGATION_PARSE_LOG_MAX_ITEM_ENTRIES', 100)
+
+# Zoom levels at which area label masks are precomputed after parsing. No
+# label masks are built unless the zoom levels are specified.
+LABEL_MASK_ZOOMS = getattr(settings, 'RASTER_AGGREGATION_LABEL_MASK_ZOOMS', ())
+
+# Zoom levels at which the tile coverage of the areas is indexed after
+# parsing. No index is built unless the zoom levels are specified.
+TILE_COVERAGE_ZOOMS = getattr(settings, 'RASTER_AGGREGATION_TILE_COVERAGE_ZOOMS', ())
+
+# Cache the value histograms of tiles that are fully covered by an area.
+TILE_HISTOGRAM_CACHE = getattr(settings, 'RASTER_AGGREGATION_TILE_HISTOGRAM_CACHE', True)
+
+# Number of zoom levels per band of precomputed simplified geometries.
+SIMPLIFICATION_ZOOM_STEP = getattr(settings, 'RASTER_AGGREGATION_SIMPLIFICATION_ZOOM_STEP', 2)
+
+# Simplification tolerance of the zoom bands in pixels, at the highest zoom
+# level of the band.
+SIMPLIFICATION_PIXELS = getattr(settings, 'RASTER_AGGREGATION_SIMPLIFICATION_PIXELS', 1)
+
+SIMPLIFICATION_SQL = """
+INSERT INTO {simplification} (aggregationarea_id, min_zoom, max_zoom, geom)
+SELECT id, %s, %s, ST_Multi(ST_SimplifyPreserveTopology(geom, %s))
+FROM {area}
+WHERE aggregationlayer_id = %s
+"""
+
+SIMPLIFIED_GEOMETRY_SQL = """
+COALESCE((
+    SELECT simplification.geom FROM {simplification} simplification
+    WHERE simplification.aggregationarea_id = {area}.id
+    AND simplification.min_zoom <= %s AND simplification.max_zoom >= %s
+    LIMIT 1
+), {area}.geom_simplified)
+"""
+
+# Extent and buffer of mapbox vector tiles in tile coordinates.
+VECTOR_TILE_EXTENT = getattr(settings, 'RASTER_AGGREGATION_VECTOR_TILE_EXTENT', 4096)
+VECTOR_TILE_BUFFER = getattr(settings, 'RASTER_AGGREGATION_VECTOR_TILE_BUFFER', 64)
+
+VECTOR_TILE_SQL = """
+WITH bounds AS (
+    SELECT ST_MakeEnvelope(%s, %s, %s, %s, {srid}) AS geom
+)
+SELECT ST_AsMVT(tile, %s, {extent}, 'geom') FROM (
+    SELECT {area}.id, {area}.name{value_column},
+    ST_AsMVTGeom({geom}, bounds.geom, {extent}, {buffer}, true) AS geom
+    FROM bounds, {area}{value_join}
+    WHERE {area}.aggregationlayer_id = %s AND {area}.geom && bounds.geom
+) AS tile
+WHERE tile.geom IS NOT NULL
+"""
 
 
 class AggregationLayer(models.Model):
@@ -23,6 +93,7 @@ class AggregationLayer(models.Model):
     max_zoom_level = models.IntegerField(default=18)
     simplification_tolerance = models.FloatField(default=0.01)
     parse_log = models.TextField(blank=True, null=True, default='')
+    shapefile_checksum = models.CharField(max_length=32, blank=True, null=True)
     modified = models.DateTimeField(auto_now=True)
 
     def __str__(self):
@@ -31,20 +102,279 @@ class AggregationLayer(models.Model):
             count=self.aggregationarea_set.all().count()
         )
 
-    def log(self, msg, reset=False):
+    def log(self, msg, reset=False, level='info', fid=None, area_id=None):
         """
         Write a message to the parse log of the aggregationlayer instance.
+        Use an AggregationLayerLog for writing many messages.
         """
-        # Prepare datetime stamp for log
-        now = '[{0}] '.format(datetime.datetime.now().strftime('%Y-%m-%d %T'))
-
-        # Write log, reset if requested
+        logger = AggregationLayerLog(self)
         if reset:
-            self.parse_log = now + msg
-        else:
-            self.parse_log += '\n' + now + msg
+            logger.reset()
+        logger.log(msg, level=level, fid=fid, area_id=area_id)
+        logger.flush()
+
+    def render_parse_log(self):
+        """
+        Render the log entries of this layer into the parse log summary. The
+        number of entries for individual features or areas is limited.
+        """
+        entries = self.aggregationlayerlogentry_set.all()
+
+        # Get entries that are not specific to a feature or an area
+        layer_entries = list(entries.filter(fid__isnull=True, area_id__isnull=True))
+
+        # Get a limited number of feature and area specific entries
+        item_entries = entries.exclude(fid__isnull=True, area_id__isnull=True)
+        item_count = item_entries.count()
+        item_entries = list(item_entries[:PARSE_LOG_MAX_ITEM_ENTRIES])
+
+        # Render entries in the order they were written
+        parse_log = '\n'.join(
+            str(entry) for entry in sorted(layer_entries + item_entries, key=lambda entry: entry.id)
+        )
+
+        if item_count > len(item_entries):
+            parse_log += '\n... {0} more feature and area entries omitted'.format(
+                item_count - len(item_entries)
+            )
+
+        # Update the summary without touching the modified date
+        self.parse_log = parse_log
+        AggregationLayer.objects.filter(id=self.id).update(parse_log=parse_log)
+
+    def build_label_masks(self, zooms=None):
+        """
+        Precompute the area label masks of this layer for the given zoom
+        levels, replacing any existing masks. By default, the configured
+        label mask zoom levels are used.
+        """
+        if zooms is None:
+            zooms = LABEL_MASK_ZOOMS
+
+        self.aggregationlayerlabelmask_set.all().delete()
+
+        areas = [(area.id, area.geom) for area in self.aggregationarea_set.all()]
+
+        for zoom in set(zooms):
+            batch = []
+            for tilex, tiley, labels, label_sets in build_label_masks(areas, zoom):
+                batch.append(AggregationLayerLabelMask(
+                    aggregationlayer=self,
+                    tilez=zoom,
+                    tilex=tilex,
+                    tiley=tiley,
+                    labels=encode_labels(labels),
+                    label_sets=json.dumps(label_sets),
+                    layer_modified=self.modified,
+                ))
+                if len(batch) >= 100:
+                    AggregationLayerLabelMask.objects.bulk_create(batch)
+                    batch = []
+            AggregationLayerLabelMask.objects.bulk_create(batch)
+
+    def build_tile_coverage(self, zooms=None):
+        """
+        Index the tiles covered by the areas of this layer for the given zoom
+        levels, replacing any existing index. By default, the configured tile
+        coverage zoom levels are used.
+        """
+        if zooms is None:
+            zooms = TILE_COVERAGE_ZOOMS
+
+        AggregationAreaTile.objects.filter(aggregationarea__aggregationlayer=self).delete()
+
+        batch = []
+        for area in self.aggregationarea_set.all():
+            for entry in area.get_tile_coverage_entries(zooms):
+                batch.append(entry)
+                if len(batch) >= 1000:
+                    AggregationAreaTile.objects.bulk_create(batch)
+                    batch = []
+        AggregationAreaTile.objects.bulk_create(batch)
+
+    def build_simplifications(self):
+        """
+        Precompute simplified geometries of the areas of this layer for zoom
+        bands between the minimum and maximum zoom levels of the layer. The
+        tolerance of a band is derived from the web mercator pixel size at
+        the highest zoom level of the band.
+        """
+        AggregationAreaSimplification.objects.filter(aggregationarea__aggregationlayer=self).delete()
+
+        sql = SIMPLIFICATION_SQL.format(
+            simplification=AggregationAreaSimplification._meta.db_table,
+            area=AggregationArea._meta.db_table,
+        )
+        with connection.cursor() as cursor:
+            for min_zoom in range(self.min_zoom_level, self.max_zoom_level + 1, SIMPLIFICATION_ZOOM_STEP):
+                max_zoom = min(min_zoom + SIMPLIFICATION_ZOOM_STEP - 1, self.max_zoom_level)
+                tolerance = tile_scale(max_zoom) * SIMPLIFICATION_PIXELS
+                cursor.execute(sql, [min_zoom, max_zoom, tolerance, self.id])
+
+        # Invalidate responses that were served without the simplifications,
+        # also if the generations are derived from the database.
+        self.aggregationarea_set.update(modified=timezone.now())
+        bump_layer_generation(self.id)
+
+    def get_vector_tile(self, tilez, tilex, tiley, value_count_parameters=None):
+        """
+        Encode the areas of this layer that intersect a tile as a mapbox
+        vector tile, using the simplified geometries of the zoom band of the
+        tile. If value count parameters are given, the existing value count
+        results of the areas are added as json encoded value attribute.
+        Results are not computed.
+        """
+        area_table = AggregationArea._meta.db_table
+        geom_sql, geom_params = AggregationArea.get_simplified_geometry_sql(tilez)
+
+        value_column = value_join = ''
+        value_params = []
+        if value_count_parameters:
+            results = ValueCountResult.objects.filter(
+                aggregationarea__aggregationlayer=self, **value_count_parameters
+            ).values('aggregationarea_id', 'value')
+            results_sql, value_params = results.query.sql_with_params()
+            value_column = ', hstore_to_json(results.value)::text AS value'
+            value_join = ' LEFT JOIN ({0}) results ON results.aggregationarea_id = {1}.id'.format(
+                results_sql, area_table
+            )
+
+        sql = VECTOR_TILE_SQL.format(
+            srid=WEB_MERCATOR_SRID,
+            extent=VECTOR_TILE_EXTENT,
+            buffer=VECTOR_TILE_BUFFER,
+            area=area_table,
+            geom=geom_sql,
+            value_column=value_column,
+            value_join=value_join,
+        )
+        params = list(tile_bounds(tilex, tiley, tilez)) + ['aggregationareas'] + geom_params
+        params += list(value_params) + [self.id]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            tile = cursor.fetchone()[0]
+
+        return bytes(tile) if tile else b''
+
+    def get_label_masks(self, zoom, areas=None):
+        """
+        Get the precomputed label masks for a zoom level as a generator of
+        tile indices, compressed label arrays and area id sets. If a queryset
+        of areas is given, only the masks of tiles within the extent of the
+        areas are loaded. Returns None if no label masks are available for
+        the current version of the layer.
+        """
+        masks = self.aggregationlayerlabelmask_set.filter(tilez=zoom, layer_modified=self.modified)
+        if not masks.exists():
+            return
+
+        if areas is not None:
+            extent = areas.aggregate(extent=Extent('geom'))['extent']
+            if extent is None:
+                return iter(())
+            index_range = tile_index_range(extent, zoom)
+            masks = masks.filter(
+                tilex__gte=index_range[0], tilex__lte=index_range[2],
+                tiley__gte=index_range[1], tiley__lte=index_range[3],
+            )
+
+        return (mask.get_labels() for mask in masks.iterator())
 
-        self.save()
+
+class AggregationLayerLogEntry(models.Model):
+    """
+    Parse and compute events of an aggregation layer.
+    """
+    DEBUG = 'debug'
+    INFO = 'info'
+    WARNING = 'warning'
+    ERROR = 'error'
+    LEVEL_CHOICES = (
+        (DEBUG, 'Debug'),
+        (INFO, 'Info'),
+        (WARNING, 'Warning'),
+        (ERROR, 'Error'),
+    )
+    aggregationlayer = models.ForeignKey(AggregationLayer)
+    level = models.CharField(max_length=10, choices=LEVEL_CHOICES, default=INFO)
+    message = models.TextField()
+    fid = models.IntegerField(blank=True, null=True)
+    area_id = models.IntegerField(blank=True, null=True)
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ('id', )
+
+    def __str__(self):
+        return '[{0}] {1}'.format(self.created.strftime('%Y-%m-%d %T'), self.message)
+
+
+class AggregationLayerLog(object):
+    """
+    Buffered writer for aggregation layer log entries. The entries are
+    written in batches, and the parse log summary is rendered on flush.
+    """
+
+    def __init__(self, agglayer, buffer_size=None):
+        self.agglayer = agglayer
+        self.buffer_size = buffer_size or LOG_BUFFER_SIZE
+        self.buffer = []
+
+    def log(self, msg, level=AggregationLayerLogEntry.INFO, fid=None, area_id=None):
+        """
+        Add a log entry to the buffer, flush if the buffer is full.
+        """
+        self.buffer.append(AggregationLayerLogEntry(
+            aggregationlayer=self.agglayer,
+            level=level,
+            message=msg,
+            fid=fid,
+            area_id=area_id,
+        ))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def reset(self):
+        """
+        Remove all existing log entries of the aggregation layer.
+        """
+        self.buffer = []
+        self.agglayer.aggregationlayerlogentry_set.all().delete()
+
+    def flush(self):
+        """
+        Write buffered entries to the database and render the parse log.
+        """
+        if self.buffer:
+            AggregationLayerLogEntry.objects.bulk_create(self.buffer)
+            self.buffer = []
+        self.agglayer.render_parse_log()
+
+
+class AggregationLayerLabelMask(models.Model):
+    """
+    Precomputed label array of the aggregation areas intersecting with a
+    tile. The labels refer to sets of area ids, stored as json.
+    """
+    aggregationlayer = models.ForeignKey(AggregationLayer)
+    tilez = models.PositiveSmallIntegerField()
+    tilex = models.IntegerField()
+    tiley = models.IntegerField()
+    labels = models.BinaryField()
+    label_sets = models.TextField()
+    layer_modified = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('aggregationlayer', 'tilez', 'tilex', 'tiley')
+
+    def get_labels(self):
+        """
+        Get the tile index, the compressed label array and the decoded area id
+        sets. The label array is decoded when the tile is counted.
+        """
+        label_sets = [tuple(area_ids) for area_ids in json.loads(self.label_sets)]
+        return self.tilex, self.tiley, bytes(self.labels), label_sets
 
 
 class AggregationArea(models.Model):
@@ -55,14 +385,17 @@ class AggregationArea(models.Model):
     aggregationlayer = models.ForeignKey(AggregationLayer, blank=True, null=True)
     geom = models.MultiPolygonField(srid=WEB_MERCATOR_SRID)
     geom_simplified = models.MultiPolygonField(srid=WEB_MERCATOR_SRID, blank=True, null=True)
+    geom_hash = models.CharField(max_length=32, blank=True, null=True, db_index=True)
+    modified = models.DateTimeField(auto_now=True)
     objects = models.GeoManager()
 
     def __str__(self):
         return "{lyr} - {name}".format(lyr=self.aggregationlayer.name, name=self.name)
 
-    def save(self, *args, **kwargs):
+    def simplify(self):
         """
-        Reduce the geometries to simplified version.
+        Compute the simplified version of the geometry, using the
+        simplification tolerance of the aggregation layer.
         """
         geom = self.geom.simplify(
             tolerance=self.aggregationlayer.simplification_tolerance,
@@ -70,8 +403,335 @@ class AggregationArea(models.Model):
         )
         geom = convert_to_multipolygon(geom)
         self.geom_simplified = geom
+
+    def save(self, *args, **kwargs):
+        """
+        Reduce the geometries to simplified version.
+        """
+        self.simplify()
+        geom_hash = geometry_hash(self.geom, self.aggregationlayer.simplification_tolerance)
+        geometry_changed = self.pk is None or geom_hash != self.geom_hash
+        self.geom_hash = geom_hash
         super(AggregationArea, self).save(*args, **kwargs)
 
+        if geometry_changed:
+            # Rebuild the tile coverage index for the indexed zoom levels
+            zooms = set(self.aggregationareatile_set.values_list('zoom', flat=True))
+            if zooms:
+                self.aggregationareatile_set.all().delete()
+                AggregationAreaTile.objects.bulk_create(self.get_tile_coverage_entries(zooms))
+
+            # Remove outdated simplifications, the simplified geometry is used
+            # until the simplifications of the layer are rebuilt.
+            self.aggregationareasimplification_set.all().delete()
+
+            # The label masks of the layer include the old geometry, the
+            # areas are rasterized until the masks are rebuilt.
+            AggregationLayerLabelMask.objects.filter(aggregationlayer_id=self.aggregationlayer_id).delete()
+
+    @classmethod
+    def get_simplified_geometry_sql(cls, zoom):
+        """
+        Get the sql expression and parameters for selecting the simplified
+        geometry of the zoom band that contains a zoom level, falling back to
+        the simplified geometry of the area.
+        """
+        sql = SIMPLIFIED_GEOMETRY_SQL.format(
+            simplification=AggregationAreaSimplification._meta.db_table,
+            area=cls._meta.db_table,
+        )
+        return sql, [zoom, zoom]
+
+    def get_tile_coverage_entries(self, zooms):
+        """
+        Create the unsaved tile coverage index entries of this area for a
+        list of zoom levels.
+        """
+        return [
+            AggregationAreaTile(
+                aggregationarea=self,
+                zoom=zoom,
+                tilez=tilez,
+                tilex=tilex,
+                tiley=tiley,
+                fully_covered=fully_covered,
+            )
+            for zoom in set(zooms)
+            for tilez, tilex, tiley, fully_covered in get_tile_coverage_blocks(self.geom, zoom)
+        ]
+
+    def get_tile_coverage(self, zoom, tilerange=None):
+        """
+        Get the tile indices and fully covered flags of the tiles intersecting
+        with this area, within the tile range if provided. Uses the tile
+        coverage index if it is available for the zoom level, otherwise the
+        coverage is computed from the geometry.
+        """
+        blocks = list(self.aggregationareatile_set.filter(zoom=zoom).values_list(
+            'tilez', 'tilex', 'tiley', 'fully_covered',
+        ))
+        if blocks:
+            return list(expand_tile_coverage(blocks, zoom, tilerange))
+        return list(get_tile_coverage(self.geom, zoom, tilerange))
+
+
+class AggregationAreaSimplification(models.Model):
+    """
+    Simplified geometry of an aggregation area for a band of zoom levels.
+    """
+    aggregationarea = models.ForeignKey(AggregationArea)
+    min_zoom = models.PositiveSmallIntegerField()
+    max_zoom = models.PositiveSmallIntegerField()
+    geom = models.MultiPolygonField(srid=WEB_MERCATOR_SRID)
+
+    class Meta:
+        index_together = ('aggregationarea', 'min_zoom', 'max_zoom')
+
+
+class AggregationAreaTile(models.Model):
+    """
+    Tile coverage index of aggregation areas at a zoom level. Each entry is a
+    tile that intersects with the area, flagged if the tile is fully
+    covered. Fully covered tiles are stored at the lowest zoom level at
+    which they are covered, and expanded when the index is read.
+    """
+    aggregationarea = models.ForeignKey(AggregationArea)
+    zoom = models.PositiveSmallIntegerField()
+    tilez = models.PositiveSmallIntegerField()
+    tilex = models.IntegerField()
+    tiley = models.IntegerField()
+    fully_covered = models.BooleanField(default=False)
+
+    class Meta:
+        index_together = ('aggregationarea', 'zoom')
+
+
+class TileValueCount(models.Model):
+    """
+    Value histogram of a formula evaluated on a raster tile. The digest
+    identifies the formula and the layer names, the histogram does not
+    depend on the grouping.
+    """
+    digest = models.CharField(max_length=32)
+    layer_names = HStoreField()
+    tilez = models.PositiveSmallIntegerField()
+    tilex = models.IntegerField()
+    tiley = models.IntegerField()
+    value = HStoreField()
+
+    class Meta:
+        unique_together = ('digest', 'tilez', 'tilex', 'tiley')
+
+
+class TileValueCountCache(object):
+    """
+    Cache of tile value histograms for a formula and layer names at a zoom
+    level, used by the area aggregator for fully covered tiles.
+    """
+
+    def __init__(self, layer_names, formula, zoom):
+        self.layer_names = {key: str(val) for key, val in layer_names.items()}
+        self.zoom = zoom
+        self.digest = hashlib.md5(
+            json.dumps([formula, sorted(self.layer_names.items())]).encode()
+        ).hexdigest()
+
+    def get_many(self, tiles):
+        """
+        Get the cached histograms for a list of tile indices.
+        """
+        if not tiles:
+            return {}
+        tiles = set(tiles)
+        tilexs, tileys = zip(*tiles)
+        cached = TileValueCount.objects.filter(
+            digest=self.digest,
+            tilez=self.zoom,
+            tilex__in=set(tilexs),
+            tiley__in=set(tileys),
+        ).values_list('tilex', 'tiley', 'value')
+        return {
+            (tilex, tiley): {float(key): int(val) for key, val in value.items()}
+            for tilex, tiley, value in cached if (tilex, tiley) in tiles
+        }
+
+    def set_many(self, histograms):
+        """
+        Store a dictionary of histograms by tile index.
+        """
+        try:
+            with transaction.atomic():
+                TileValueCount.objects.bulk_create([
+                    TileValueCount(
+                        digest=self.digest,
+                        layer_names=self.layer_names,
+                        tilez=self.zoom,
+                        tilex=tilex,
+                        tiley=tiley,
+                        value={repr(key): str(val) for key, val in histogram.items()},
+                    )
+                    for (tilex, tiley), histogram in histograms.items()
+                ])
+        except IntegrityError:
+            # The histograms were stored concurrently by another worker
+            pass
+
+
+class ValueCountResultManager(models.Manager):
+
+    def get_lock_key(self, aggregationarea, formula, layer_names, zoom, units='', grouping='auto'):
+        """
+        Compute a signed 64 bit advisory lock key for the value count
+        parameters.
+        """
+        area_id = getattr(aggregationarea, 'id', aggregationarea)
+        key = json.dumps([
+            area_id, formula, sorted((k, str(v)) for k, v in layer_names.items()), zoom, units, str(grouping),
+        ])
+        return int(hashlib.md5(key.encode()).hexdigest()[:16], 16) - 2 ** 63
+
+    def lock(self, aggregationareas, formula, layer_names, zoom, units='', grouping='auto'):
+        """
+        Take transaction level advisory locks on the value count results of a
+        list of areas or area ids. The locks are taken in a consistent order
+        to prevent deadlocks between concurrent writers.
+        """
+        keys = sorted(set(
+            self.get_lock_key(area, formula, layer_names, zoom, units, grouping) for area in aggregationareas
+        ))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT pg_advisory_xact_lock(key) FROM (SELECT unnest(%s::bigint[]) AS key ORDER BY key) AS keys',
+                [keys],
+            )
+
+    def get_or_compute(self, aggregationarea, formula, layer_names, zoom, units='', grouping='auto'):
+        """
+        Get a value count result or compute it if it does not exist yet.
+
+        Concurrent computations of the same result are prevented with a
+        transaction level advisory lock on the result parameters. Requests
+        that wait for the lock reuse the result of the first request, as do
+        requests that collide with a result created without the lock.
+        Returns the result and a boolean that is True if it was computed.
+        """
+        params = dict(
+            aggregationarea=aggregationarea,
+            formula=formula,
+            layer_names=layer_names,
+            zoom=zoom,
+            units=units,
+            grouping=grouping,
+        )
+        try:
+            return self.get(**params), False
+        except self.model.DoesNotExist:
+            pass
+
+        with transaction.atomic():
+            self.lock([aggregationarea], formula, layer_names, zoom, units, grouping)
+
+            # The result might have been computed while waiting for the lock
+            try:
+                return self.get(**params), False
+            except self.model.DoesNotExist:
+                pass
+
+            try:
+                with transaction.atomic():
+                    return self.create(**params), True
+            except IntegrityError:
+                # The result was created concurrently without the lock
+                return self.get(**params), False
+
+    def get_or_compute_many(self, area_ids, formula, layer_names, zoom, units='', grouping='auto'):
+        """
+        Get the value count results for a list of area ids in a single query.
+        Missing results are computed together in a single pass over the
+        tiles if the grouping allows it, holding the same advisory locks as
+        get_or_compute. Returns a dictionary of results by area id.
+        """
+        params = dict(formula=formula, layer_names=layer_names, zoom=zoom, units=units, grouping=grouping)
+
+        results = {
+            result.aggregationarea_id: result
+            for result in self.filter(aggregationarea_id__in=area_ids, **params)
+        }
+        missing = [area_id for area_id in area_ids if area_id not in results]
+        if not missing:
+            return results
+
+        if not LayerAggregator.supports(grouping, layer_names):
+            for area in AggregationArea.objects.filter(id__in=missing):
+                results[area.id], created = self.get_or_compute(area, **params)
+            return results
+
+        with transaction.atomic():
+            self.lock(missing, **params)
+
+            # Results might have been computed while waiting for the locks
+            results.update(
+                (result.aggregationarea_id, result)
+                for result in self.filter(aggregationarea_id__in=missing, **params)
+            )
+            missing = [area_id for area_id in missing if area_id not in results]
+            if not missing:
+                return results
+
+            agg = LayerAggregator(
+                AggregationArea.objects.filter(id__in=missing), layer_names, formula,
+                zoom=zoom, acres=units.lower() == 'acres', grouping=grouping,
+            )
+            created = self.bulk_create_values(agg.value_counts(), **params)
+            results.update((result.aggregationarea_id, result) for result in created)
+
+        return results
+
+    def bulk_create_values(self, values, formula, layer_names, zoom, units='', grouping='auto'):
+        """
+        Create value count results from precomputed values, given as a
+        dictionary of value counts by area id. Existing results with the same
+        parameters are replaced, holding the same advisory locks as
+        get_or_compute.
+        """
+        results = self.filter(
+            aggregationarea_id__in=list(values.keys()),
+            formula=formula,
+            layer_names=layer_names,
+            zoom=zoom,
+            units=units,
+            grouping=grouping,
+        )
+        with transaction.atomic():
+            self.lock(values.keys(), formula, layer_names, zoom, units, grouping)
+            results.delete()
+
+            self.bulk_create([
+                self.model(
+                    aggregationarea_id=area_id,
+                    formula=formula,
+                    layer_names=layer_names,
+                    zoom=zoom,
+                    units=units,
+                    grouping=grouping,
+                    value={k: str(v) for k, v in value.items()},
+                )
+                for area_id, value in values.items()
+            ])
+
+            # Get the ids of the created results, bulk_create only sets them
+            # on recent Django versions.
+            results = list(results.all())
+
+            # Add raster layers for tracking change and invalidation
+            Through = self.model.rasterlayers.through
+            Through.objects.bulk_create([
+                Through(valuecountresult_id=result.id, rasterlayer_id=int(layer_id))
+                for result in results for layer_id in set(layer_names.values())
+            ])
+
+        return results
+
 
 class ValueCountResult(models.Model):
     """
@@ -87,6 +747,8 @@ class ValueCountResult(models.Model):
     value = HStoreField()
     created = models.DateTimeField(auto_now=True)
 
+    objects = ValueCountResultManager()
+
     class Meta:
         unique_together = (
             'aggregationarea', 'formula', 'layer_names', 'zoom', 'units', 'grouping',
@@ -99,15 +761,30 @@ class ValueCountResult(models.Model):
         """
         Compute value count on save using the objects value count parameters.
         """
-        # Compute aggregate result
-        agg = Aggregator(
-            layer_dict=self.layer_names,
-            formula=self.formula,
-            zoom=self.zoom,
-            geom=self.aggregationarea.geom,
-            acres=self.units.lower() == 'acres',
-            grouping=self.grouping,
-        )
+        # Compute aggregate result, using the tile coverage of the area if
+        # the grouping is supported.
+        if AreaAggregator.supports(self.grouping, self.layer_names):
+            agg = AreaAggregator(
+                geom=self.aggregationarea.geom,
+                layer_dict=self.layer_names,
+                formula=self.formula,
+                zoom=self.zoom,
+                acres=self.units.lower() == 'acres',
+                grouping=self.grouping,
+                histograms=TileValueCountCache(self.layer_names, self.formula, self.zoom)
+                if TILE_HISTOGRAM_CACHE else None,
+            )
+            # Expand the tile coverage of the area within the layers only
+            agg.coverage = self.aggregationarea.get_tile_coverage(agg.zoom, agg.tilerange)
+        else:
+            agg = Aggregator(
+                layer_dict=self.layer_names,
+                formula=self.formula,
+                zoom=self.zoom,
+                geom=self.aggregationarea.geom,
+                acres=self.units.lower() == 'acres',
+                grouping=self.grouping,
+            )
         aggregation_result = agg.value_count()
 
         # Convert values to string for storage in hstore
@@ -125,12 +802,104 @@ class ValueCountResult(models.Model):
             self.rasterlayers.add(lyr)
 
 
+class ValueCountJob(models.Model):
+    """
+    Progress of a value count computation for all areas of an aggregation
+    layer.
+    """
+    RUNNING = 'running'
+    FINISHED = 'finished'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (RUNNING, 'Running'),
+        (FINISHED, 'Finished'),
+        (FAILED, 'Failed'),
+    )
+    aggregationlayer = models.ForeignKey(AggregationLayer)
+    formula = models.TextField()
+    layer_names = HStoreField()
+    zoom = models.PositiveSmallIntegerField()
+    units = models.TextField(default='')
+    grouping = models.TextField(default='auto')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=RUNNING)
+    total = models.IntegerField(default=0)
+    done = models.IntegerField(default=0)
+    failed = models.IntegerField(default=0)
+    started = models.DateTimeField(default=timezone.now)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ('-id', )
+
+    def __str__(self):
+        return '{0} - {1}/{2} areas ({3})'.format(self.aggregationlayer.name, self.done, self.total, self.status)
+
+    def add_progress(self, done=0, failed=0):
+        """
+        Increment the progress counters of the job, safe for concurrent
+        chunks.
+        """
+        ValueCountJob.objects.filter(id=self.id).update(done=F('done') + done, failed=F('failed') + failed)
+
+    def finish(self, failed=False):
+        """
+        Mark the job as finished, or as failed if no area was computed or if
+        the job failed.
+        """
+        self.refresh_from_db()
+        self.status = self.FAILED if failed or (self.total and not self.done) else self.FINISHED
+        self.finished = timezone.now()
+        self.save(update_fields=['status', 'finished'])
+
+    @property
+    def throughput(self):
+        """
+        Number of processed areas per second.
+        """
+        seconds = ((self.finished or timezone.now()) - self.started).total_seconds()
+        if not seconds:
+            return
+        return (self.done + self.failed) / seconds
+
+    @property
+    def eta(self):
+        """
+        Estimated number of seconds until all areas are processed.
+        """
+        if self.status != self.RUNNING or not self.throughput:
+            return
+        return (self.total - self.done - self.failed) / self.throughput
+
+
+@receiver(post_save, sender=AggregationLayer)
+def invalidate_responses_after_aggregationlayer_change(sender, instance, **kwargs):
+    """
+    Invalidate cached responses of the aggregation layer, for instance after
+    it was parsed.
+    """
+    bump_layer_generation(instance.id)
+
+
+@receiver(post_save, sender=AggregationArea)
+def invalidate_responses_after_aggregationarea_change(sender, instance, **kwargs):
+    """
+    Invalidate cached responses of the aggregation layer of a changed area.
+    """
+    if instance.aggregationlayer_id:
+        bump_layer_generation(instance.aggregationlayer_id)
+
+
 @receiver(rasterlayers_parser_ended, sender=RasterLayer)
 def remove_aggregation_results_after_rasterlayer_change(sender, instance, **kwargs):
     """
-    Delete ValueCountResults that depend on the rasterlayer that was changed.
+    Delete ValueCountResults, tile histograms and cached tiles that depend on
+    the rasterlayer that was changed.
     """
     ValueCountResult.objects.filter(rasterlayers=instance).delete()
+    TileValueCount.objects.filter(layer_names__values__contains=[str(instance.id)]).delete()
+    if tile_cache is not None:
+        tile_cache.invalidate(instance.id)
+    bump_generations([RESULTS_GENERATION])
 
 
 @receiver(post_save, sender=Legend)
@@ -139,3 +908,4 @@ def remove_aggregation_results_after_legend_change(sender, instance, **kwargs):
     Delete ValueCountResults that depend on the legend that was changed.
     """
     ValueCountResult.objects.filter(grouping=instance.id).delete()
+    bump_generations([RESULTS_GENERATION])
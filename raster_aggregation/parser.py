@@ -0,0 +1,710 @@
+import binascii
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import traceback
+import uuid
+import zipfile
+
+from django.conf import settings
+from django.contrib.gis.gdal import CoordTransform, DataSource, OGRGeometry, SpatialReference
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import six
+from raster_aggregation.exceptions import AggregationLayerParseError
+from raster_aggregation.models import AggregationArea, AggregationLayer, AggregationLayerLog, AggregationLayerLogEntry
+from raster_aggregation.utils import (
+    WEB_MERCATOR_SRID, convert_to_multipolygon, convert_to_multipolygons, format_tolerance, geometry_hash
+)
+
+# Number of aggregation areas that are simplified and inserted together.
+PARSE_BATCH_SIZE = getattr(settings, 'RASTER_AGGREGATION_PARSE_BATCH_SIZE', 1000)
+
+# Ingest modes, either process features in python or stage the raw features
+# in the database and process them with a single set based statement.
+INGEST_PYTHON = 'python'
+INGEST_COPY = 'copy'
+INGEST_MODE = getattr(settings, 'RASTER_AGGREGATION_INGEST_MODE', INGEST_PYTHON)
+
+# Update existing areas on re-parse instead of replacing them, using the
+# python ingest mode.
+INCREMENTAL_PARSE = getattr(settings, 'RASTER_AGGREGATION_INCREMENTAL_PARSE', False)
+
+# Number of features parsed by one task when parsing layers in parallel.
+PARSE_CHUNK_SIZE = getattr(settings, 'RASTER_AGGREGATION_PARSE_CHUNK_SIZE', 10000)
+
+# Name template of the staging tables, the names are unique per ingest so that
+# concurrent or nested ingests do not collide. Parses in chunks use an unlogged
+# table that is shared by the chunk tasks, other ingests a temporary table.
+STAGING_TABLE = 'raster_aggregation_staging_{agglayer_id}_{suffix}'
+
+STAGING_INSERT_SQL = """
+WITH cleaned AS (
+    SELECT fid, name, ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_Force2D({transform})), 3)) AS geom
+    FROM {staging}
+), inserted AS (
+    INSERT INTO {table} (name, aggregationlayer_id, geom, geom_simplified, geom_hash, modified)
+    SELECT name, %(agglayer_id)s, geom,
+        ST_Multi(ST_CollectionExtract(ST_MakeValid(ST_SimplifyPreserveTopology(geom, %(tolerance)s)), 3)),
+        md5(ST_AsBinary(geom) || convert_to(%(tolerance_key)s, 'UTF8')), now()
+    FROM cleaned
+    WHERE geom IS NOT NULL AND NOT ST_IsEmpty(geom) AND ST_IsValid(geom) AND ST_Area(geom) > 0
+    RETURNING id
+)
+SELECT fid, NULL FROM cleaned
+WHERE geom IS NULL OR ST_IsEmpty(geom) OR NOT ST_IsValid(geom) OR NOT ST_Area(geom) > 0
+UNION ALL
+SELECT NULL, count(*) FROM inserted
+"""
+
+
+def copy_value(value):
+    """
+    Format a value for the text format of the COPY command.
+    """
+    if value is None:
+        return '\\N'
+    return six.text_type(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class CopyStream(object):
+    """
+    File like object that reads lines from an iterator, to stream data into
+    the COPY command without holding it in memory.
+    """
+
+    def __init__(self, lines):
+        self.lines = iter(lines)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.lines)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+class StagedFeature(object):
+    """
+    Feature read from the staging table of a parse in chunks, with the
+    attributes of OGR features that are used by the parser.
+    """
+
+    def __init__(self, fid, name, wkb, srs):
+        self.fid = fid
+        self.name = name
+        self.wkb = wkb
+        self.srs = srs
+
+    @property
+    def geom(self):
+        return OGRGeometry(self.wkb, self.srs)
+
+    def get(self, field):
+        return self.name
+
+
+class AggregationLayerParser(object):
+    """
+    Class to parse the shapefile of an aggregation layer into aggregation
+    areas.
+    """
+
+    def __init__(self, agglayer_id, batch_size=None, mode=None, incremental=None):
+        self.agglayer = AggregationLayer.objects.get(id=agglayer_id)
+        self.batch_size = batch_size or PARSE_BATCH_SIZE
+        self.mode = mode or INGEST_MODE
+        self.incremental = INCREMENTAL_PARSE if incremental is None else incremental
+        self.checksum = None
+        self.existing_areas = None
+        self.kept_area_ids = set()
+        self.tmpdir = None
+        self.datasource = None
+        self.layer = None
+        self.ct = None
+        self.batch = []
+        self.area_count = 0
+        self.logger = AggregationLayerLog(self.agglayer)
+
+    def log(self, msg, level=AggregationLayerLogEntry.INFO, fid=None):
+        """
+        Write a message to the buffered log of the aggregation layer.
+        """
+        self.logger.log(msg, level=level, fid=fid)
+
+    def get_zipfile_path(self):
+        """
+        Get a local path to the zipped shapefile. Files in local storage are
+        read in place, other files are downloaded into a temporary directory.
+        The checksum of downloaded files is computed while they are streamed.
+        """
+        checksum = hashlib.md5()
+
+        try:
+            shapefilepath = self.agglayer.shapefile.path
+        except NotImplementedError:
+            shapefilepath = None
+
+        if shapefilepath:
+            try:
+                for chunk in self.agglayer.shapefile.chunks():
+                    checksum.update(chunk)
+            except:
+                raise AggregationLayerParseError('Error: Could not open file, aborted parsing')
+            finally:
+                self.agglayer.shapefile.close()
+            self.checksum = checksum.hexdigest()
+            return shapefilepath
+
+        self.tmpdir = tempfile.mkdtemp()
+
+        shapefilepath = os.path.join(self.tmpdir, os.path.basename(self.agglayer.shapefile.name))
+
+        # Access shapefile and store locally
+        try:
+            with open(shapefilepath, 'wb') as shapefile:
+                for chunk in self.agglayer.shapefile.chunks():
+                    checksum.update(chunk)
+                    shapefile.write(chunk)
+        except:
+            raise AggregationLayerParseError('Error: Could not download file, aborted parsing')
+        finally:
+            self.agglayer.shapefile.close()
+
+        self.checksum = checksum.hexdigest()
+        return shapefilepath
+
+    def open_layer(self):
+        """
+        Open the first layer of the zipped shapefile. The zipfile is read in
+        place through the GDAL virtual file system, without extracting it.
+        """
+        shapefilepath = self.get_zipfile_path()
+
+        # Find the shapefile in the zipfile, only reads the zip directory
+        try:
+            with zipfile.ZipFile(shapefilepath) as zf:
+                names = [name for name in zf.namelist() if name.lower().endswith('.shp')]
+        except:
+            raise AggregationLayerParseError('Error: Could not open zipfile, aborted parsing')
+
+        vsipath = '/vsizip/' + shapefilepath
+        if names:
+            vsipath = '/'.join([vsipath, sorted(names)[0]])
+
+        # Set shapefile as datasource for GDAL and get layer
+        try:
+            self.datasource = DataSource(vsipath)
+            self.layer = self.datasource[0]
+        except:
+            raise AggregationLayerParseError('Error: Failed to extract layer from shapefile, aborted parsing')
+
+        # Check if name column exists
+        if self.agglayer.name_column.lower() not in [field.lower() for field in self.layer.fields]:
+            raise AggregationLayerParseError(
+                'Error: Name column "{0}" not found, aborted parsing. '
+                'Available columns: {1}'.format(self.agglayer.name_column, self.layer.fields)
+            )
+
+        # Setup transformation to default ref system
+        try:
+            self.ct = CoordTransform(self.layer.srs, SpatialReference(WEB_MERCATOR_SRID))
+        except:
+            raise AggregationLayerParseError('Error: Layer srs not specified, aborted parsing')
+
+    def close_layer(self):
+        """
+        Close the datasource and remove the tempdir with downloaded shapefile.
+        """
+        self.layer = None
+        self.datasource = None
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir)
+            self.tmpdir = None
+
+    def get_geometry(self, feat):
+        """
+        Transform the geometry of a feature to the default reference system.
+        Returns None if not possible.
+        """
+        # Get geometry and transform to WGS84
+        try:
+            wgsgeom = feat.geom
+            wgsgeom.transform(self.ct)
+        except:
+            self.log(
+                'Warning: Failed to transform feature fid {0}'.format(feat.fid),
+                level=AggregationLayerLogEntry.WARNING, fid=feat.fid,
+            )
+            return
+
+        try:
+            # Ignore z-dim
+            wgsgeom.coord_dim = 2
+            return wgsgeom.geos
+        except:
+            self.log(
+                'Warning: Failed to convert feature fid {0} to'
+                ' multipolygon'.format(feat.fid),
+                level=AggregationLayerLogEntry.WARNING, fid=feat.fid,
+            )
+
+    def repair_geometries(self, batch):
+        """
+        Assure that the geometries of a batch of features are valid
+        multipolygons. Returns the list of features that could be converted.
+        """
+        try:
+            geoms = convert_to_multipolygons([geom for fid, name, geom in batch])
+        except:
+            # Convert geometries one by one to isolate the failing features
+            geoms = []
+            for fid, name, geom in batch:
+                try:
+                    geoms.append(convert_to_multipolygon(geom))
+                except:
+                    self.log(
+                        'Warning: Failed to convert feature fid {0} to'
+                        ' multipolygon'.format(fid),
+                        level=AggregationLayerLogEntry.WARNING, fid=fid,
+                    )
+                    geoms.append(None)
+
+        result = []
+        for (fid, name, wgsgeom), geom in zip(batch, geoms):
+            if geom is None:
+                continue
+
+            # Add warning if geom is not valid
+            if geom.valid_reason != 'Valid Geometry':
+                self.log(
+                    'Warning: Found invalid geometry for'
+                    ' feature fid {0}'.format(fid),
+                    level=AggregationLayerLogEntry.WARNING, fid=fid,
+                )
+                continue
+
+            # If geom is empty, conversion was not successful, issue
+            # warning and continue
+            if geom.empty:
+                self.log(
+                    'Warning: Failed to convert feature fid'
+                    ' {0} to valid geometry'.format(fid),
+                    level=AggregationLayerLogEntry.WARNING, fid=fid,
+                )
+                continue
+
+            result.append((fid, name, geom))
+
+        return result
+
+    def process_features(self, features):
+        """
+        Convert features into aggregation areas and write them to the database
+        in batches.
+        """
+        start = time.time()
+
+        for feat in features:
+            geom = self.get_geometry(feat)
+            if geom is None:
+                continue
+
+            self.batch.append((feat.fid, feat.get(self.agglayer.name_column), geom))
+
+            if len(self.batch) >= self.batch_size:
+                self.write_batch()
+
+        self.write_batch()
+
+        elapsed = time.time() - start
+        self.log(
+            'Created {count} aggregation areas in {elapsed:.1f} seconds '
+            '({rate:.0f} rows/second)'.format(
+                count=self.area_count,
+                elapsed=elapsed,
+                rate=self.area_count / elapsed if elapsed else 0,
+            )
+        )
+
+    @staticmethod
+    def area_key(name):
+        """
+        Normalize area names for comparing features with existing areas.
+        """
+        return name if name is None else six.text_type(name)
+
+    def load_existing_areas(self):
+        """
+        Index the existing areas of the layer by name and geometry hash.
+        """
+        self.existing_areas = {}
+        self.kept_area_ids = set()
+        for area_id, name, geom_hash in self.agglayer.aggregationarea_set.values_list('id', 'name', 'geom_hash'):
+            self.existing_areas.setdefault((self.area_key(name), geom_hash), []).append(area_id)
+
+    def remove_outdated_areas(self):
+        """
+        Remove existing areas that were not found in the shapefile, this also
+        removes their value count results.
+        """
+        outdated = [
+            area_id for ids in self.existing_areas.values() for area_id in ids
+            if area_id not in self.kept_area_ids
+        ]
+        for i in range(0, len(outdated), self.batch_size):
+            AggregationArea.objects.filter(id__in=outdated[i:i + self.batch_size]).delete()
+
+        self.log(
+            'Incremental parse kept {kept} unchanged areas and removed {removed} '
+            'outdated areas'.format(kept=len(self.kept_area_ids), removed=len(outdated))
+        )
+
+    def get_parse_key(self):
+        """
+        Combine the shapefile checksum with the layer settings that affect
+        the parsed areas. Parsing is skipped if the key did not change since
+        the last successful parse.
+        """
+        if self.checksum is None:
+            return
+        key = '|'.join([
+            self.checksum, self.agglayer.name_column, format_tolerance(self.agglayer.simplification_tolerance),
+        ])
+        return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+    def write_batch(self):
+        """
+        Repair and simplify the geometries of the current batch and insert the
+        batch in a single transaction. If the bulk insert fails, the areas are
+        created one by one to isolate the failing features.
+        """
+        if not self.batch:
+            return
+
+        batch = self.repair_geometries(self.batch)
+        self.batch = []
+
+        areas = []
+        for fid, name, geom in batch:
+            geom_hash = geometry_hash(geom, self.agglayer.simplification_tolerance)
+
+            # Keep existing areas with the same name and geometry
+            if self.existing_areas is not None:
+                ids = self.existing_areas.get((self.area_key(name), geom_hash))
+                if ids:
+                    self.kept_area_ids.add(ids.pop())
+                    continue
+
+            areas.append((fid, AggregationArea(
+                name=name,
+                aggregationlayer=self.agglayer,
+                geom=geom,
+                geom_hash=geom_hash,
+            )))
+
+        # Compute simplified geometries, same as on AggregationArea.save.
+        try:
+            simplified = convert_to_multipolygons([
+                area.geom.simplify(tolerance=self.agglayer.simplification_tolerance, preserve_topology=True)
+                for fid, area in areas
+            ])
+        except:
+            simplified = [None] * len(areas)
+
+        batch = []
+        for (fid, area), geom in zip(areas, simplified):
+            try:
+                if geom is None:
+                    area.simplify()
+                else:
+                    area.geom_simplified = geom
+            except:
+                self.log(
+                    'Warning: Failed to create AggregationArea '
+                    'for feature fid {0}'.format(fid),
+                    level=AggregationLayerLogEntry.WARNING, fid=fid,
+                )
+                continue
+            batch.append((fid, area))
+
+        try:
+            with transaction.atomic():
+                AggregationArea.objects.bulk_create([area for fid, area in batch])
+            self.area_count += len(batch)
+        except:
+            for fid, area in batch:
+                try:
+                    with transaction.atomic():
+                        area.save()
+                    self.area_count += 1
+                except:
+                    self.log(
+                        'Warning: Failed to create AggregationArea '
+                        'for feature fid {0}'.format(fid),
+                        level=AggregationLayerLogEntry.WARNING, fid=fid,
+                    )
+
+    def staging_rows(self, features):
+        """
+        Generator of COPY rows with the fid, name and raw geometry of every
+        feature.
+        """
+        for feat in features:
+            try:
+                wkb = '\\\\x' + binascii.hexlify(bytes(feat.geom.wkb)).decode()
+            except:
+                wkb = '\\N'
+            yield '{fid}\t{name}\t{wkb}\n'.format(
+                fid=feat.fid,
+                name=copy_value(feat.get(self.agglayer.name_column)),
+                wkb=wkb,
+            )
+
+    def process_features_copy(self, features):
+        """
+        Stream the raw features into a staging table and create the
+        aggregation areas with a single set based statement.
+        """
+        start = time.time()
+
+        # Transform the staged geometries in the database, use the proj4
+        # definition if the layer srs has no srid.
+        srid = self.layer.srs.srid
+        if srid:
+            transform = 'ST_Transform(ST_SetSRID(ST_GeomFromWKB(wkb), {0}), {1})'.format(int(srid), WEB_MERCATOR_SRID)
+            params = {}
+        else:
+            transform = 'ST_Transform(ST_GeomFromWKB(wkb), %(proj4)s, {0})'.format(WEB_MERCATOR_SRID)
+            params = {'proj4': self.layer.srs.proj4}
+
+        params.update({
+            'agglayer_id': self.agglayer.id,
+            'tolerance': self.agglayer.simplification_tolerance,
+            'tolerance_key': format_tolerance(self.agglayer.simplification_tolerance),
+        })
+
+        staging = STAGING_TABLE.format(agglayer_id=self.agglayer.id, suffix=uuid.uuid4().hex[:12])
+
+        sql = STAGING_INSERT_SQL.format(
+            transform=transform,
+            staging=staging,
+            table=AggregationArea._meta.db_table,
+        )
+
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    'CREATE TEMPORARY TABLE {0} (fid integer, name text, wkb bytea) '
+                    'ON COMMIT DROP'.format(staging)
+                )
+                cursor.copy_expert(
+                    'COPY {0} (fid, name, wkb) FROM STDIN'.format(staging),
+                    CopyStream(self.staging_rows(features)),
+                )
+                cursor.execute(sql, params)
+                rows = cursor.fetchall()
+        except:
+            raise AggregationLayerParseError(
+                'Error: Failed to ingest features through staging table, aborted parsing\n'
+                + traceback.format_exc()
+            )
+
+        for fid, count in rows:
+            if fid is None:
+                self.area_count = count
+            else:
+                self.log(
+                    'Warning: Failed to convert feature fid'
+                    ' {0} to valid geometry'.format(fid),
+                    level=AggregationLayerLogEntry.WARNING, fid=fid,
+                )
+
+        elapsed = time.time() - start
+        self.log(
+            'Created {count} aggregation areas in {elapsed:.1f} seconds '
+            '({rate:.0f} rows/second)'.format(
+                count=self.area_count,
+                elapsed=elapsed,
+                rate=self.area_count / elapsed if elapsed else 0,
+            )
+        )
+
+    def finish(self):
+        """
+        Flush the log and update the parse key and the modification date of
+        the layer with the new areas.
+        """
+        self.logger.flush()
+        self.agglayer.shapefile_checksum = self.get_parse_key()
+        self.agglayer.save(update_fields=['modified', 'shapefile_checksum'])
+        self.agglayer.log('Finished parsing Aggregation Layer {0}'.format(self.agglayer.id))
+
+    def parse(self):
+        """
+        Parse the shapefile into aggregation areas. Existing areas of the
+        aggregation layer are replaced, or updated for incremental parsing.
+        Returns True if the areas were updated.
+        """
+        # Clean the log entries of previous parses
+        self.logger.reset()
+        self.log('Started parsing Aggregation Layer {0}'.format(self.agglayer.id))
+
+        try:
+            self.open_layer()
+
+            # Skip incremental parsing if the file and the parse settings did
+            # not change since the last successful parse.
+            if self.incremental and self.get_parse_key() == self.agglayer.shapefile_checksum:
+                self.log('Shapefile has not changed since last parse with the same settings, skipped parsing')
+                return
+
+            if self.incremental:
+                self.load_existing_areas()
+                self.process_features(self.layer)
+                self.remove_outdated_areas()
+            else:
+                # Remove existing patches before re-creating them
+                self.agglayer.aggregationarea_set.all().delete()
+
+                if self.mode == INGEST_COPY:
+                    self.process_features_copy(self.layer)
+                else:
+                    self.process_features(self.layer)
+        except AggregationLayerParseError as e:
+            self.log(str(e), level=AggregationLayerLogEntry.ERROR)
+            return
+        finally:
+            self.close_layer()
+            self.logger.flush()
+
+        self.finish()
+
+        return True
+
+    def stage_features(self, staging):
+        """
+        Copy the raw features of the layer into a staging table that is shared
+        by the chunk tasks, so that the shapefile is only read once.
+        """
+        try:
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.execute(
+                    'CREATE UNLOGGED TABLE {0} (fid integer PRIMARY KEY, name text, wkb bytea)'.format(staging)
+                )
+                cursor.copy_expert(
+                    'COPY {0} (fid, name, wkb) FROM STDIN'.format(staging),
+                    CopyStream(self.staging_rows(self.layer)),
+                )
+        except:
+            raise AggregationLayerParseError(
+                'Error: Failed to stage features for parsing in chunks, aborted parsing\n'
+                + traceback.format_exc()
+            )
+
+    def get_staged_features(self, staging, srs, start, stop):
+        """
+        Get the staged features in a range of feature ids.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT fid, name, wkb FROM {0} WHERE fid >= %s AND fid < %s ORDER BY fid'.format(staging),
+                [start, stop],
+            )
+            rows = cursor.fetchall()
+        return [StagedFeature(fid, name, wkb, srs) for fid, name, wkb in rows]
+
+    def drop_staging_table(self, staging):
+        """
+        Remove the staging table of a parse in chunks.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('DROP TABLE IF EXISTS {0}'.format(staging))
+
+    def prepare_chunks(self, chunk_size=None):
+        """
+        Prepare parsing the shapefile in chunks. The features are staged in
+        the database for the chunk tasks. Returns a list of feature id ranges,
+        one for each chunk.
+
+        The staging table, the layer srs and the last id of the existing areas
+        are stored on the parser. The existing areas are kept until all
+        chunks have been parsed, see finish_chunks and abort_chunks.
+        """
+        # Clean the log entries of previous parses
+        self.logger.reset()
+        self.log('Started parsing Aggregation Layer {0} in chunks'.format(self.agglayer.id))
+
+        try:
+            self.open_layer()
+
+            self.srs = self.layer.srs.wkt
+            self.previous_area_id = self.agglayer.aggregationarea_set.aggregate(Max('id'))['id__max']
+            self.staging = STAGING_TABLE.format(agglayer_id=self.agglayer.id, suffix=uuid.uuid4().hex[:12])
+            self.stage_features(self.staging)
+
+            nr_of_features = len(self.layer)
+        except AggregationLayerParseError as e:
+            self.log(str(e), level=AggregationLayerLogEntry.ERROR)
+            return
+        finally:
+            self.close_layer()
+            self.logger.flush()
+
+        chunk_size = chunk_size or PARSE_CHUNK_SIZE
+
+        return [
+            (start, min(start + chunk_size, nr_of_features))
+            for start in range(0, nr_of_features, chunk_size)
+        ]
+
+    def parse_chunk(self, staging, srs, start, stop):
+        """
+        Parse the staged features in a range of feature ids. The chunk is
+        written in a single transaction so that it can be retried on failure.
+        Returns the number of areas that were created.
+        """
+        srs = SpatialReference(srs)
+        self.ct = CoordTransform(srs, SpatialReference(WEB_MERCATOR_SRID))
+        try:
+            with transaction.atomic():
+                self.process_features(self.get_staged_features(staging, srs, start, stop))
+        finally:
+            self.logger.flush()
+
+        return self.area_count
+
+    def finish_chunks(self, staging, previous_area_id=None):
+        """
+        Replace the areas of the previous parse with the areas created by the
+        chunks and remove the staged features.
+        """
+        if previous_area_id is not None:
+            self.agglayer.aggregationarea_set.filter(id__lte=previous_area_id).delete()
+        self.drop_staging_table(staging)
+        self.finish()
+
+    def abort_chunks(self, staging, previous_area_id=None):
+        """
+        Remove the areas created by the chunks of a failed parse and the
+        staged features. The areas of the previous parse are kept.
+        """
+        areas = self.agglayer.aggregationarea_set.all()
+        if previous_area_id is not None:
+            areas = areas.filter(id__gt=previous_area_id)
+        areas.delete()
+        self.drop_staging_table(staging)
+        self.agglayer.log(
+            'Error: Failed to parse Aggregation Layer {0} in chunks, kept the previous areas'.format(self.agglayer.id),
+            level=AggregationLayerLogEntry.ERROR,
+        )
@@ -0,0 +1,47 @@
+import re
+import uuid
+
+from rest_framework.renderers import JSONRenderer
+
+
+class RawJSON(object):
+    """
+    Serialized JSON text, such as GeoJSON generated by the database, that is
+    inserted into the response as is.
+    """
+
+    def __init__(self, text):
+        self.text = text
+
+
+class RawJSONRenderer(JSONRenderer):
+    """
+    JSON renderer that splices RawJSON values into the rendered output,
+    without parsing and encoding them again.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        fragments = []
+        token = uuid.uuid4().hex
+
+        class RawJSONEncoder(self.encoder_class):
+
+            def default(self, obj):
+                # Encode raw json as a placeholder that is replaced after rendering
+                if isinstance(obj, RawJSON):
+                    fragments.append(obj.text)
+                    return 'rawjson:{0}:{1}'.format(token, len(fragments) - 1)
+                return super(RawJSONEncoder, self).default(obj)
+
+        encoder_class = self.encoder_class
+        self.encoder_class = RawJSONEncoder
+        try:
+            ret = super(RawJSONRenderer, self).render(data, accepted_media_type, renderer_context)
+        finally:
+            self.encoder_class = encoder_class
+
+        if not fragments:
+            return ret
+
+        placeholder = re.compile('"rawjson:{0}:([0-9]+)"'.format(token).encode())
+        return placeholder.sub(lambda match: fragments[int(match.group(1))].encode(), ret)
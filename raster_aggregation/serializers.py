@@ -3,7 +3,61 @@ from raster.models import RasterLayer
 from rest_framework import serializers
 from rest_framework_gis.serializers import GeoFeatureModelSerializer
 
-from .models import AggregationArea, AggregationLayer, ValueCountResult
+from .models import AggregationArea, AggregationLayer, ValueCountJob, ValueCountResult
+from .renderers import RawJSON
+
+
+def parse_value_count_parameters(request):
+    """
+    Parse the value count parameters from the request query parameters.
+    Returns a dictionary with the formula, layer names, zoom, units and
+    grouping.
+    """
+    # Get layer ids
+    ids = request.GET.get('layers').split(',')
+
+    # Parse layer ids into dictionary with variable names
+    ids = {idx.split('=')[0]: idx.split('=')[1] for idx in ids}
+
+    # Get formula
+    formula = request.GET.get('formula')
+
+    # Clean formula
+    formula = formula.strip().replace(' ', '')
+
+    # Get zoom level
+    if 'zoom' in request.GET:
+        zoom = int(request.GET.get('zoom'))
+    else:
+        # Compute zoom if not provided. Work at the resolution of the
+        # input layer with the highest zoom level by default, or the
+        # lowest one if requested.
+        qs = RasterLayer.objects.filter(id__in=ids.values())
+        zlevels = qs.values_list('metadata__max_zoom', flat=True)
+        if 'minmaxzoom' in request.GET:
+            # Get the minimum of maxzoom levels
+            zoom = min(zlevels)
+        elif 'maxzoom' in request.GET:
+            # Limit maximum zoom level
+            maxzoom = int(request.GET.get('maxzoom'))
+            zoom = min(max(zlevels), maxzoom)
+        else:
+            # Compute at the maximum maxzoom (resolution of highest definition layer)
+            zoom = max(zlevels)
+
+    # Get boolean to return data in acres if requested
+    acres = 'acres' if 'acres' in request.GET else ''
+
+    # Get grouping parameter
+    grouping = request.GET.get('grouping', 'auto')
+
+    return {
+        'formula': formula,
+        'layer_names': ids,
+        'zoom': zoom,
+        'units': acres,
+        'grouping': grouping,
+    }
 
 
 class AggregationAreaSimplifiedSerializer(serializers.ModelSerializer):
@@ -15,6 +69,11 @@ class AggregationAreaSimplifiedSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'geom')
 
     def get_geom(self, obj):
+        # Use the rounded GeoJSON generated by the database if available
+        geojson = getattr(obj, 'geom_geojson', None)
+        if geojson is not None:
+            return RawJSON(geojson)
+
         # Transform geom to WGS84
         obj.geom_simplified.transform(4326)
 
@@ -53,56 +112,18 @@ class AggregationAreaValueSerializer(serializers.ModelSerializer):
         Should currently only be used with categorical rasters, as it will look
         for unique values.
         """
-        # Get request object
-        request = self.context['request']
-
-        # Get layer ids
-        ids = request.GET.get('layers').split(',')
-
-        # Parse layer ids into dictionary with variable names
-        ids = {idx.split('=')[0]: idx.split('=')[1] for idx in ids}
-
-        # Get formula
-        formula = request.GET.get('formula')
-
-        # Clean formula
-        formula = formula.strip().replace(' ', '')
-
-        # Get zoom level
-        if 'zoom' in request.GET:
-            zoom = int(request.GET.get('zoom'))
+        # Use results that were fetched for all areas of the list
+        results = self.context.get('value_count_results')
+        if results is not None and obj.id in results:
+            result = results[obj.id]
         else:
-            # Compute zoom if not provided. Work at the resolution of the
-            # input layer with the highest zoom level by default, or the
-            # lowest one if requested.
-            qs = RasterLayer.objects.filter(id__in=ids.values())
-            zlevels = qs.values_list('metadata__max_zoom', flat=True)
-            if 'minmaxzoom' in request.GET:
-                # Get the minimum of maxzoom levels
-                zoom = min(zlevels)
-            elif 'maxzoom' in request.GET:
-                # Limit maximum zoom level
-                maxzoom = int(request.GET.get('maxzoom'))
-                zoom = min(max(zlevels), maxzoom)
-            else:
-                # Compute at the maximum maxzoom (resolution of highest definition layer)
-                zoom = max(zlevels)
-
-        # Get boolean to return data in acres if requested
-        acres = 'acres' if 'acres' in request.GET else ''
-
-        # Get grouping parameter
-        grouping = request.GET.get('grouping', 'auto')
-
-        # Get or create impact value result
-        result, created = ValueCountResult.objects.get_or_create(
-            aggregationarea=obj,
-            formula=formula,
-            layer_names=ids,
-            zoom=zoom,
-            units=acres,
-            grouping=grouping
-        )
+            params = self.context.get('value_count_parameters')
+            if params is None:
+                params = parse_value_count_parameters(self.context['request'])
+
+            # Get or compute impact value result, concurrent requests for the
+            # same result share a single computation
+            result, created = ValueCountResult.objects.get_or_compute(aggregationarea=obj, **params)
 
         # Convert keys to strings and hstore values to floats
         result = {str(k): float(v) for k, v in result.value.items()}
@@ -120,3 +141,13 @@ class AggregationLayerSerializer(serializers.ModelSerializer):
 
     def get_nr_of_areas(self, obj):
         return obj.aggregationarea_set.count()
+
+
+class ValueCountJobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = ValueCountJob
+        fields = (
+            'id', 'aggregationlayer', 'formula', 'layer_names', 'zoom', 'units', 'grouping',
+            'status', 'total', 'done', 'failed', 'throughput', 'eta', 'started', 'finished',
+        )
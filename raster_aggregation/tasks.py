@@ -1,157 +1,202 @@
-import os
-import shutil
-import tempfile
+import math
 import traceback
-import zipfile
+from collections import Counter
 
-from celery import task
+from celery import chord, task
 from raster.models import RasterLayer
 
-from django.contrib.gis.gdal import CoordTransform, DataSource, SpatialReference
-from raster_aggregation.models import AggregationLayer, ValueCountResult
-from raster_aggregation.utils import WEB_MERCATOR_SRID, convert_to_multipolygon
+from django.conf import settings
+from django.contrib.gis.geos import Polygon
+from django.core.cache import cache
+from raster_aggregation.caching import RESULTS_GENERATION, bump_generations
+from raster_aggregation.models import (
+    TILE_HISTOGRAM_CACHE, AggregationArea, AggregationLayer, AggregationLayerLog, AggregationLayerLogEntry,
+    TileValueCountCache, ValueCountJob, ValueCountResult
+)
+from raster_aggregation.parser import AggregationLayerParser
+from raster_aggregation.utils import convert_to_multipolygon
+from raster_aggregation.valuecount import (
+    AreaAggregator, LayerAggregator, TileAggregator, get_coverage_extent, get_layers_tile_range, split_coverage
+)
+
+# Number of areas computed per task in layer wide value count jobs.
+VALUE_COUNT_CHUNK_SIZE = getattr(settings, 'RASTER_AGGREGATION_VALUE_COUNT_CHUNK_SIZE', 500)
+
+# Areas covering more tiles than this are split into parts that are
+# aggregated in parallel.
+SUBDIVIDE_MAX_TILES = getattr(settings, 'RASTER_AGGREGATION_SUBDIVIDE_MAX_TILES', 2000)
+
+# Areas with more vertices than this are split into parts that are
+# aggregated in parallel.
+SUBDIVIDE_MAX_VERTICES = getattr(settings, 'RASTER_AGGREGATION_SUBDIVIDE_MAX_VERTICES', 100000)
+
+
+def run_layer_task(layer_task, agglayer_id, called_directly=False):
+    """
+    Run a task for an AggregationLayer as a separate worker task, or in the
+    current process if the calling task was not run by a worker.
+    """
+    if called_directly:
+        layer_task.apply(args=(agglayer_id, ))
+    else:
+        layer_task.delay(agglayer_id)
 
 
-@task()
-def aggregation_layer_parser(agglayer_id):
+@task(bind=True)
+def aggregation_layer_parser(self, agglayer_id, mode=None, incremental=None):
     """
     This function pushes the shapefile data from the AggregationLayer
-    into the AggregationArea table.
+    into the AggregationArea table. The tile coverage index and the label
+    masks are built by separate tasks.
     """
-    # Get aggregation layer.
-    agglayer = AggregationLayer.objects.get(id=agglayer_id)
-
-    # Clean previous parse log
-    agglayer.log('Started parsing Aggregation Layer {0}'.format(agglayer.id))
+    parser = AggregationLayerParser(agglayer_id, mode=mode, incremental=incremental)
+    if parser.parse():
+        build_aggregation_layer_simplifications(agglayer_id)
+        run_layer_task(build_aggregation_layer_tile_coverage, agglayer_id, self.request.called_directly)
+        run_layer_task(build_aggregation_layer_label_masks, agglayer_id, self.request.called_directly)
 
-    tmpdir = tempfile.mkdtemp()
 
-    shapefilename = os.path.basename(agglayer.shapefile.name)
-
-    shapefilepath = os.path.join(tmpdir, shapefilename)
+@task()
+def aggregation_layer_parallel_parser(agglayer_id, chunk_size=None):
+    """
+    Parse the AggregationLayer in parallel, splitting the features into
+    chunks that are parsed by separate tasks.
+    """
+    parser = AggregationLayerParser(agglayer_id)
+    chunks = parser.prepare_chunks(chunk_size)
 
-    # Get zipped shapefile from storage
-    try:
-        # Access shapefile and store locally
-        shapefile = open(shapefilepath, 'wb')
-        for chunk in agglayer.shapefile.chunks():
-            shapefile.write(chunk)
-        shapefile.close()
-    except:
-        shutil.rmtree(tmpdir)
-        agglayer.log('Error: Could not download file, aborted parsing')
+    if chunks is None:
         return
-
-    # Open and extract zipfile
-    try:
-        zf = zipfile.ZipFile(shapefilepath)
-        zf.extractall(tmpdir)
-    except:
-        shutil.rmtree(tmpdir)
-        agglayer.log('Error: Could not open zipfile, aborted parsing')
+    elif not chunks:
+        finish_aggregation_layer_parser([], agglayer_id, parser.checksum, parser.staging, parser.previous_area_id)
         return
 
-    # Remove zipfile
-    os.remove(shapefilepath)
+    # The previous areas are replaced when all chunks succeeded, otherwise
+    # the areas of the finished chunks are removed again.
+    chord(
+        aggregation_layer_chunk_parser.si(agglayer_id, parser.staging, parser.srs, start, stop)
+        for start, stop in chunks
+    )(
+        finish_aggregation_layer_parser.s(
+            agglayer_id, parser.checksum, parser.staging, parser.previous_area_id
+        ).on_error(
+            fail_aggregation_layer_parser.si(agglayer_id, parser.staging, parser.previous_area_id)
+        )
+    )
 
-    # Set shapefile as datasource for GDAL and get layer
-    try:
-        ds = DataSource(tmpdir)
-        lyr = ds[0]
-    except:
-        shutil.rmtree(tmpdir)
-        agglayer.log('Error: Failed to extract layer from shapefile, aborted parsing')
-        return
 
-    # Check if name column exists
-    if agglayer.name_column.lower() not in [field.lower() for field in lyr.fields]:
-        agglayer.log(
-            'Error: Name column "{0}" not found, aborted parsing. '
-            'Available columns: {1}'.format(agglayer.name_column, lyr.fields)
+@task(bind=True, max_retries=3, default_retry_delay=30)
+def aggregation_layer_chunk_parser(self, agglayer_id, staging, srs, start, stop):
+    """
+    Parse the staged features of an AggregationLayer in a range of feature
+    ids. Failed chunks are retried.
+    """
+    parser = AggregationLayerParser(agglayer_id)
+    try:
+        return parser.parse_chunk(staging, srs, start, stop)
+    except Exception as exc:
+        parser.agglayer.log(
+            'Error: Failed to parse features {0} to {1}, attempt {2}\n{3}'.format(
+                start, stop, self.request.retries + 1, traceback.format_exc()
+            ),
+            level=AggregationLayerLogEntry.ERROR,
         )
-        return
+        raise self.retry(exc=exc)
 
-    # Setup transformation to default ref system
-    try:
-        ct = CoordTransform(lyr.srs, SpatialReference(WEB_MERCATOR_SRID))
-    except:
-        shutil.rmtree(tmpdir)
-        agglayer.log('Error: Layer srs not specified, aborted parsing')
-        return
 
-    # Remove existing patches before re-creating them
-    agglayer.aggregationarea_set.all().delete()
+@task(bind=True)
+def finish_aggregation_layer_parser(self, area_counts, agglayer_id, checksum=None, staging=None,
+                                    previous_area_id=None):
+    """
+    Write the parse summary after all chunks of an AggregationLayer have been
+    parsed and replace the areas of the previous parse. The checksum of the
+    shapefile is passed on from the preparation of the chunks.
+    """
+    parser = AggregationLayerParser(agglayer_id)
+    parser.checksum = checksum
+    parser.log('Created {0} aggregation areas in {1} chunks'.format(sum(area_counts), len(area_counts)))
+    parser.finish_chunks(staging, previous_area_id)
 
-    # Loop through features
-    for feat in lyr:
-        # Get geometry and transform to WGS84
-        try:
-            wgsgeom = feat.geom
-            wgsgeom.transform(ct)
-        except:
-            agglayer.log('Warning: Failed to transform feature fid {0}\n'.format(feat.fid))
-            continue
+    build_aggregation_layer_simplifications(agglayer_id)
+    run_layer_task(build_aggregation_layer_tile_coverage, agglayer_id, self.request.called_directly)
+    run_layer_task(build_aggregation_layer_label_masks, agglayer_id, self.request.called_directly)
 
-        try:
-            # Ignore z-dim
-            wgsgeom.coord_dim = 2
 
-            # Assure that feature is a valid multipolygon
-            geom = convert_to_multipolygon(wgsgeom.geos)
-        except:
-            agglayer.log(
-                'Warning: Failed to convert feature fid {0} to'
-                ' multipolygon\n'.format(feat.fid)
-            )
-            continue
+@task()
+def fail_aggregation_layer_parser(agglayer_id, staging, previous_area_id=None):
+    """
+    Remove the areas of a parallel parse of which a chunk failed, keeping
+    the areas of the previous parse.
+    """
+    AggregationLayerParser(agglayer_id).abort_chunks(staging, previous_area_id)
 
-        # Add warning if geom is not valid
-        if geom.valid_reason != 'Valid Geometry':
-            agglayer.log(
-                'Warning: Found invalid geometry for'
-                ' feature fid {0}\n'.format(feat.fid)
-            )
-            continue
-
-        # If geom is empty, conversion was not successful, issue
-        # warning and continue
-        if geom.empty:
-            agglayer.log(
-                'Warning: Failed to convert feature fid'
-                ' {0} to valid geometry\n'.format(feat.fid)
-            )
-            continue
 
-        # Create aggregation area
-        try:
-            agglayer.aggregationarea_set.create(
-                name=feat.get(agglayer.name_column),
-                aggregationlayer=agglayer,
-                geom=geom
-            )
-        except:
-            agglayer.log(
-                'Warning: Failed to create AggregationArea '
-                'for feature fid {0}\n'.format(feat.fid)
-            )
+@task()
+def build_aggregation_layer_simplifications(agglayer_id):
+    """
+    Precompute the simplified area geometries of an AggregationLayer for its
+    zoom bands.
+    """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+    try:
+        agglayer.build_simplifications()
+    except:
+        agglayer.log(
+            'Error: Failed to build simplified geometries\n{0}'.format(traceback.format_exc()),
+            level=AggregationLayerLogEntry.ERROR,
+        )
 
-    agglayer.log('Finished parsing Aggregation Layer {0}'.format(agglayer.id))
 
-    # Remove tempdir with unzipped shapefile
-    shutil.rmtree(tmpdir)
+@task()
+def build_aggregation_layer_tile_coverage(agglayer_id, zooms=None):
+    """
+    Index the tiles covered by the areas of an AggregationLayer.
+    """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+    try:
+        agglayer.build_tile_coverage(zooms)
+    except:
+        agglayer.log(
+            'Error: Failed to build tile coverage index\n{0}'.format(traceback.format_exc()),
+            level=AggregationLayerLogEntry.ERROR,
+        )
 
 
 @task()
-def compute_value_count_for_aggregation_layer(obj, layer_id, compute_area=True, grouping='auto'):
+def build_aggregation_layer_label_masks(agglayer_id, zooms=None):
     """
-    Precomputes value counts for a given aggregation area and a rasterlayer.
+    Precompute the area label masks of an AggregationLayer.
     """
+    agglayer = AggregationLayer.objects.get(id=agglayer_id)
+    try:
+        agglayer.build_label_masks(zooms)
+    except:
+        agglayer.log(
+            'Error: Failed to build label masks\n{0}'.format(traceback.format_exc()),
+            level=AggregationLayerLogEntry.ERROR,
+        )
+
+
+@task(bind=True)
+def compute_value_count_for_aggregation_layer(self, agglayer_id, layer_id, compute_area=True, grouping='auto',
+                                              chunk_size=None):
+    """
+    Precomputes value counts for all areas of an aggregation layer and a
+    rasterlayer. The areas are split into chunks that are computed by
+    separate tasks, the progress is tracked in a value count job. Returns
+    the job id.
+
+    When called directly instead of through a worker, the chunks are
+    computed in the current process.
+    """
+    obj = AggregationLayer.objects.get(id=agglayer_id)
     rast = RasterLayer.objects.get(id=layer_id)
 
     if rast.datatype not in ['ca', 'ma']:
         obj.log(
             'ERROR: Rasterlayer {0} is not categorical. '
-            'Can only compute value counts on categorical layers'
+            'Can only compute value counts on categorical layers'.format(rast.id),
+            level=AggregationLayerLogEntry.ERROR,
         )
         return
 
@@ -159,68 +204,274 @@ def compute_value_count_for_aggregation_layer(obj, layer_id, compute_area=True,
     ids = {'a': str(rast.id)}
     formula = 'a'
     zoom = rast._max_zoom
+    units = 'acres' if compute_area else ''
+
+    # Remove existing results, invalidating cached responses and etags
+    ValueCountResult.objects.filter(
+        aggregationarea__aggregationlayer=obj,
+        rasterlayers=rast,
+        formula=formula,
+        layer_names=ids,
+    ).delete()
+    bump_generations([RESULTS_GENERATION])
+
+    area_ids = list(obj.aggregationarea_set.values_list('id', flat=True))
+    job = ValueCountJob.objects.create(
+        aggregationlayer=obj,
+        formula=formula,
+        layer_names=ids,
+        zoom=zoom,
+        units=units,
+        grouping=grouping,
+        total=len(area_ids),
+    )
 
-    # Open parse log
     obj.log(
-        'Starting Value count for AggregationLayer {agg} on RasterLayer {rst} on original Geometries'
-        .format(agg=obj.id, rst=rast.id)
+        'Starting Value count job {job} for AggregationLayer {agg} on RasterLayer {rst} on original Geometries'
+        .format(job=job.id, agg=obj.id, rst=rast.id)
     )
 
-    for area in obj.aggregationarea_set.all():
-        # Remove existing results
-        area.valuecountresult_set.filter(rasterlayers=rast, formula=formula, layer_names=ids).delete()
+    if not area_ids:
+        finish_value_count_job(job.id)
+        return job.id
+
+    # The job is marked as failed if a chunk task fails, the finish task is
+    # not called in that case.
+    chunk_size = chunk_size or VALUE_COUNT_CHUNK_SIZE
+    workflow = chord(
+        [
+            compute_value_count_chunk.si(job.id, area_ids[start:start + chunk_size])
+            for start in range(0, len(area_ids), chunk_size)
+        ],
+        finish_value_count_job.si(job.id).on_error(fail_value_count_job.si(job.id)),
+    )
+    if self.request.called_directly:
+        workflow.apply()
+    else:
+        workflow.apply_async()
+
+    return job.id
+
 
-        obj.log('Computing Value Count for area {0} and raster {1}'.format(area.id, rast.id))
+@task()
+def compute_value_count_chunk(job_id, area_ids):
+    """
+    Compute the value counts for a chunk of areas of a value count job. If
+    the chunk can not be computed in a single pass, the areas are computed
+    one by one, so that a failing area does not fail the whole chunk. Areas
+    that could not be computed are counted as failed in the job progress.
+    """
+    job = ValueCountJob.objects.get(id=job_id)
+    agglayer = job.aggregationlayer
+    logger = AggregationLayerLog(agglayer)
+    areas = agglayer.aggregationarea_set.filter(id__in=area_ids)
 
+    if LayerAggregator.supports(job.grouping, job.layer_names):
+        # Compute value counts for all areas in a single pass over the tiles
         try:
-            # Store result, this automatically creates value on save
-            ValueCountResult.objects.get_or_create(
-                aggregationarea=area,
-                formula=formula,
-                layer_names=ids,
-                zoom=zoom,
-                units='acres' if compute_area else '',
-                grouping=grouping
+            agg = LayerAggregator(
+                areas, job.layer_names, job.formula,
+                zoom=job.zoom, acres=job.units == 'acres', grouping=job.grouping,
+                label_masks=agglayer.get_label_masks(job.zoom, areas),
+            )
+            ValueCountResult.objects.bulk_create_values(
+                agg.value_counts(), job.formula, job.layer_names, job.zoom, job.units, job.grouping,
             )
+            job.add_progress(done=len(area_ids))
+            return
         except:
-            obj.log(
-                'ERROR: Failed to compute value count for '
-                'area {0} and raster {1}'.format(area.id, rast.id)
+            logger.log(
+                'WARNING: Failed to compute value counts for a chunk of {0} areas, '
+                'computing areas individually\n{1}'.format(len(area_ids), traceback.format_exc()),
+                level=AggregationLayerLogEntry.WARNING,
             )
-            obj.log(traceback.format_exc())
 
-    obj.log(
-        'Ended Value count for AggregationLayer {agg} '
-        'on RasterLayer {rst}'.format(agg=obj.id, rst=rast.id)
+    done = failed = 0
+    try:
+        for area in areas:
+            try:
+                # Store result, this automatically creates value on save
+                ValueCountResult.objects.get_or_compute(
+                    aggregationarea=area,
+                    formula=job.formula,
+                    layer_names=job.layer_names,
+                    zoom=job.zoom,
+                    units=job.units,
+                    grouping=job.grouping,
+                )
+                done += 1
+            except:
+                failed += 1
+                logger.log(
+                    'ERROR: Failed to compute value count for '
+                    'area {0} in job {1}\n{2}'.format(area.id, job.id, traceback.format_exc()),
+                    level=AggregationLayerLogEntry.ERROR, area_id=area.id,
+                )
+    except:
+        # Count the remaining areas as failed, so that the progress of the
+        # job is complete.
+        failed = len(area_ids) - done
+        logger.log(
+            'ERROR: Failed to compute value counts for a chunk of {0} areas '
+            'in job {1}\n{2}'.format(len(area_ids), job.id, traceback.format_exc()),
+            level=AggregationLayerLogEntry.ERROR,
+        )
+    job.add_progress(done=done, failed=failed)
+    logger.flush()
+
+
+@task()
+def finish_value_count_job(job_id):
+    """
+    Mark a value count job as finished and log its summary.
+    """
+    job = ValueCountJob.objects.get(id=job_id)
+    job.finish()
+    bump_generations([RESULTS_GENERATION])
+    job.aggregationlayer.log(
+        'Ended Value count job {job}, computed {done} of {total} areas, {failed} failed'.format(
+            job=job.id, done=job.done, total=job.total, failed=job.failed,
+        )
     )
 
 
 @task()
-def compute_single_value_count_result(area, formula, layer_names, zoom, units, grouping='auto'):
+def fail_value_count_job(job_id):
     """
-    Precomputes value counts for a given input set.
+    Mark a value count job as failed if one of its chunk tasks failed, so
+    that it does not remain running.
     """
-    # Compute zoom if not provided
-    if zoom is None:
-        # Get layer ids
-        ids = layer_names.split(',')
+    job = ValueCountJob.objects.get(id=job_id)
+    job.finish(failed=True)
+    bump_generations([RESULTS_GENERATION])
+    job.aggregationlayer.log(
+        'ERROR: Value count job {job} failed, computed {done} of {total} areas, {failed} failed'.format(
+            job=job.id, done=job.done, total=job.total, failed=job.failed,
+        ),
+        level=AggregationLayerLogEntry.ERROR,
+    )
+
+
+def parse_layer_names(layer_names):
+    """
+    Parse layer names string such as "a=1,b=2" into a dictionary with the
+    layer ids by variable name.
+    """
+    ids = layer_names.split(',')
+    return {idx.split('=')[0]: idx.split('=')[1] for idx in ids}
+
+
+def get_zoom(ids):
+    """
+    Compute the zoom level for the given layers, the minimum of the maximum
+    zoom levels of the layers.
+    """
+    return min(
+        RasterLayer.objects.filter(id__in=ids.values())
+        .values_list('metadata__max_zoom', flat=True)
+    )
 
-        # Parse layer ids into dictionary with variable names
-        ids = {idx.split('=')[0]: idx.split('=')[1] for idx in ids}
 
-        # Compute zoom level
-        zoom = min(
-            RasterLayer.objects.filter(id__in=ids.values())
-            .values_list('metadata__max_zoom', flat=True)
+def get_area_parts(area, zoom, tilerange=None):
+    """
+    Split the tile coverage of an area within the tile range into parts if
+    the area exceeds the subdivision thresholds. Returns None if the area is
+    not split.
+    """
+    coverage = area.get_tile_coverage(zoom, tilerange)
+    nr_of_parts = max(
+        int(math.ceil(len(coverage) / float(SUBDIVIDE_MAX_TILES))),
+        int(math.ceil(area.geom.num_points / float(SUBDIVIDE_MAX_VERTICES))),
+    )
+    if nr_of_parts < 2 or not coverage:
+        return
+    return split_coverage(coverage, nr_of_parts)
+
+
+@task()
+def compute_single_value_count_result(area_id, formula, layer_names, zoom, units, grouping='auto', pending_key=None):
+    """
+    Precomputes value counts for a given input set. Oversized areas are
+    split into parts that are aggregated in parallel.
+
+    The pending key of an asynchronous request is removed from the cache if
+    the computation fails, so that the next status request enqueues it again.
+    """
+    try:
+        area = AggregationArea.objects.get(id=area_id)
+        ids = parse_layer_names(layer_names)
+
+        # Compute zoom if not provided
+        if zoom is None:
+            zoom = get_zoom(ids)
+
+        if AreaAggregator.supports(grouping, ids):
+            layers = RasterLayer.objects.filter(id__in=ids.values())
+            parts = get_area_parts(area, zoom, get_layers_tile_range(layers, zoom))
+            if parts:
+                merge = merge_value_count_parts.s(area.id, formula, ids, zoom, units, grouping)
+                if pending_key:
+                    merge = merge.on_error(clear_pending_value_count.si(pending_key))
+                chord(
+                    compute_value_count_part.si(area.id, part, formula, ids, zoom)
+                    for part in parts
+                )(merge)
+                return
+
+        ValueCountResult.objects.get_or_compute(
+            aggregationarea=area,
+            formula=formula,
+            layer_names=ids,
+            zoom=zoom,
+            units=units,
+            grouping=grouping
         )
+    except:
+        clear_pending_value_count(pending_key)
+        raise
 
-    ValueCountResult.objects.get_or_create(
-        aggregationarea=area,
-        formula=formula,
-        layer_names=ids,
-        zoom=zoom,
-        units=units,
-        grouping=grouping
+
+@task()
+def clear_pending_value_count(pending_key):
+    """
+    Remove the pending key of a failed asynchronous value count.
+    """
+    if pending_key:
+        cache.delete(pending_key)
+
+
+@task()
+def compute_value_count_part(area_id, coverage, formula, ids, zoom):
+    """
+    Compute the pixel counts of an area on a part of its tile coverage. The
+    area geometry is clipped to the extent of the part. Returns a list of
+    value and pixel count pairs.
+    """
+    area = AggregationArea.objects.get(id=area_id)
+
+    extent = Polygon.from_bbox(get_coverage_extent(coverage, zoom))
+    extent.srid = area.geom.srid
+    geom = convert_to_multipolygon(area.geom.intersection(extent))
+
+    agg = AreaAggregator(
+        geom, ids, formula, zoom=zoom, grouping='discrete', coverage=coverage,
+        histograms=TileValueCountCache(ids, formula, zoom) if TILE_HISTOGRAM_CACHE else None,
+    )
+    return list(agg.count().items())
+
+
+@task()
+def merge_value_count_parts(counts, area_id, formula, ids, zoom, units, grouping='auto'):
+    """
+    Merge the pixel counts of the parts of an area into a value count result.
+    """
+    results = Counter()
+    for part in counts:
+        results.update(dict(part))
+
+    agg = TileAggregator(ids, formula, zoom=zoom, acres=units.lower() == 'acres', grouping=grouping)
+    ValueCountResult.objects.bulk_create_values(
+        {area_id: agg.format(results)}, formula, ids, zoom, units, grouping,
     )
 
 
@@ -229,22 +480,32 @@ def compute_batch_value_count_results(aggregationlayer, formula, layer_names, zo
     """
     Precomputes value counts for a given input set.
     """
+    ids = parse_layer_names(layer_names)
+
     # Compute zoom if not provided
     if zoom is None:
-        # Get layer ids
-        ids = layer_names.split(',')
+        zoom = get_zoom(ids)
 
-        # Parse layer ids into dictionary with variable names
-        ids = {idx.split('=')[0]: idx.split('=')[1] for idx in ids}
-
-        # Compute zoom level
-        zoom = min(
-            RasterLayer.objects.filter(id__in=ids.values())
-            .values_list('metadata__max_zoom', flat=True)
+    if LayerAggregator.supports(grouping, ids):
+        # Only compute the missing results, in a single pass over the tiles
+        existing = ValueCountResult.objects.filter(
+            aggregationarea__aggregationlayer=aggregationlayer,
+            formula=formula,
+            layer_names=ids,
+            zoom=zoom,
+            units=units,
+            grouping=grouping,
+        ).values_list('aggregationarea_id', flat=True)
+        areas = aggregationlayer.aggregationarea_set.exclude(id__in=existing)
+        agg = LayerAggregator(
+            areas, ids, formula, zoom=zoom, acres=units.lower() == 'acres', grouping=grouping,
+            label_masks=aggregationlayer.get_label_masks(zoom, areas),
         )
+        ValueCountResult.objects.bulk_create_values(agg.value_counts(), formula, ids, zoom, units, grouping)
+        return
 
     for area in aggregationlayer.aggregationarea_set.all():
-        ValueCountResult.objects.get_or_create(
+        ValueCountResult.objects.get_or_compute(
             aggregationarea=area,
             formula=formula,
             layer_names=ids,
@@ -0,0 +1,156 @@
+import json
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+
+import numpy
+
+from django.conf import settings
+
+# Directory for the worker local tile cache. The cache is disabled if no
+# directory is specified.
+TILE_CACHE_DIR = getattr(settings, 'RASTER_AGGREGATION_TILE_CACHE_DIR', None)
+
+# Maximum number of bytes of decoded tile data kept in the tile cache.
+TILE_CACHE_SIZE = getattr(settings, 'RASTER_AGGREGATION_TILE_CACHE_SIZE', 512 * 1024 * 1024)
+
+
+class TileCache(object):
+    """
+    Least recently used cache of decoded raster tile bands. The band arrays
+    are stored as npy files in a local directory and loaded as memory maps,
+    so that several worker processes on the same machine share them without
+    copies. The size budget and the recency order are tracked per process.
+
+    Bands are stored under a version of their raster layer, such as its
+    modification date, so that bands of outdated layers are not read on
+    hosts that did not receive the invalidation of the layer.
+    """
+
+    def __init__(self, directory, max_bytes=TILE_CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_path(self, layer_id, version, tilez, tilex, tiley, band):
+        """
+        Get the path of a cached band, without extension.
+        """
+        return os.path.join(
+            self.directory, str(layer_id), version, str(tilez), str(tilex), '{0}-{1}'.format(tiley, band)
+        )
+
+    def get(self, layer_id, tilez, tilex, tiley, band=0, version=None):
+        """
+        Get a cached band as a tuple of a memory mapped array and the nodata
+        value. Returns None if the band is not cached.
+        """
+        key = (int(layer_id), str(version or 0), tilez, tilex, tiley, band)
+        path = self.get_path(*key)
+        try:
+            values = numpy.load(path + '.npy', mmap_mode='r')
+            with open(path + '.json') as metadata:
+                nodata = json.load(metadata)['nodata']
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            self.discard(key)
+            return
+
+        self.hits += 1
+        # Mark as most recently used, bands written by other worker
+        # processes are registered on first use.
+        self.discard(key)
+        self.add(key, values.nbytes)
+        return values, nodata
+
+    def set(self, layer_id, tilez, tilex, tiley, band, values, nodata, version=None):
+        """
+        Store a band array and its nodata value in the cache.
+        """
+        values = numpy.ascontiguousarray(values)
+        if values.nbytes > self.max_bytes:
+            return
+
+        key = (int(layer_id), str(version or 0), tilez, tilex, tiley, band)
+        path = self.get_path(*key)
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            pass
+
+        # Write to temporary files and move them in place, so that other
+        # processes never read partially written files.
+        tmp = '{0}.{1}'.format(path, uuid.uuid4().hex)
+        with open(tmp + '.json', 'w') as metadata:
+            json.dump({'nodata': nodata}, metadata)
+        os.rename(tmp + '.json', path + '.json')
+        numpy.save(tmp + '.npy', values)
+        os.rename(tmp + '.npy', path + '.npy')
+
+        self.discard(key)
+        self.add(key, values.nbytes)
+
+    def add(self, key, nbytes):
+        """
+        Register a cached band and evict the least recently used bands until
+        the cache is within its size budget.
+        """
+        self.entries[key] = nbytes
+        self.size += nbytes
+        while self.size > self.max_bytes and self.entries:
+            oldest = next(iter(self.entries))
+            self.remove(oldest)
+
+    def discard(self, key):
+        """
+        Forget a band without removing its files.
+        """
+        self.size -= self.entries.pop(key, 0)
+
+    def remove(self, key):
+        """
+        Remove a band from the cache.
+        """
+        self.discard(key)
+        path = self.get_path(*key)
+        for extension in ('.npy', '.json'):
+            try:
+                os.remove(path + extension)
+            except OSError:
+                pass
+
+    def invalidate(self, layer_id):
+        """
+        Remove all cached bands of a raster layer, of all versions.
+        """
+        layer_id = int(layer_id)
+        for key in [key for key in self.entries if key[0] == layer_id]:
+            self.discard(key)
+        shutil.rmtree(os.path.join(self.directory, str(layer_id)), ignore_errors=True)
+
+    def clear(self):
+        """
+        Remove all cached bands.
+        """
+        self.entries.clear()
+        self.size = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self):
+        """
+        Get the cache counters.
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self.entries),
+            'bytes': self.size,
+        }
+
+
+tile_cache = TileCache(TILE_CACHE_DIR) if TILE_CACHE_DIR else None
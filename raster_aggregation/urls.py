@@ -2,14 +2,21 @@ from rest_framework import routers
 
 from django.conf.urls import include, url
 
-from .views import AggregationAreaValueViewSet
+from .views import AggregationAreaValueViewSet, AggregationLayerVectorTileView, ValueCountJobViewSet
 
 router = routers.DefaultRouter()
 
 router.register(r'aggregationareavalue', AggregationAreaValueViewSet, base_name='aggregationareavalue')
+router.register(r'valuecountjob', ValueCountJobViewSet, base_name='valuecountjob')
 
 urlpatterns = [
 
     url(r'api/', include(router.urls)),
 
+    url(
+        r'api/aggregationlayer/(?P<layer>[0-9]+)/(?P<z>[0-9]+)/(?P<x>[0-9]+)/(?P<y>[0-9]+)\.mvt$',
+        AggregationLayerVectorTileView.as_view(),
+        name='aggregationlayer-vectortile',
+    ),
+
 ]
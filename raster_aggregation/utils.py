@@ -1,8 +1,22 @@
+import hashlib
+
+import numpy
+
 from django.contrib.gis.geos import GEOSGeometry, MultiPolygon
 from django.db import connection
+from django.utils import six
+
+try:
+    import shapely
+    from shapely import GeometryType
+except ImportError:
+    shapely = None
 
 WEB_MERCATOR_SRID = 3857
 
+# Maximum number of cleaning iterations when converting to multipolygons.
+MAX_REPAIR_ITERATIONS = 10
+
 
 def convert_to_multipolygon(geom):
     """
@@ -10,6 +24,97 @@ def convert_to_multipolygon(geom):
     return an empty geometry if conversion is not possible. Examples are
     if the geometry are points or lines, then an empty geomtetry is returned.
     """
+    return convert_to_multipolygons([geom])[0]
+
+
+def convert_to_multipolygons(geoms):
+    """
+    Convert a list of geometries into valid MultiPolygons. The geometries are
+    repaired in process if shapely is installed, otherwise every geometry is
+    repaired in the database.
+    """
+    if shapely is None:
+        return [convert_to_multipolygon_sql(geom) for geom in geoms]
+
+    result = repair_multipolygon_wkb([bytes(geom.wkb) for geom in geoms])
+
+    return [
+        GEOSGeometry(six.memoryview(wkb), srid=geom.srid) if wkb else MultiPolygon([], srid=geom.srid)
+        for geom, wkb in zip(geoms, result)
+    ]
+
+
+def _extract_polygons(geoms):
+    """
+    Extract the polygons from an array of shapely geometries and combine them
+    into one multipolygon per input geometry, similar to ST_CollectionExtract.
+    Geometries without polygons are returned as None.
+    """
+    parts, index = shapely.get_parts(geoms, return_index=True)
+
+    # Flatten nested multi geometries and collections
+    while True:
+        multi = shapely.get_type_id(parts) >= GeometryType.MULTIPOINT
+        if not multi.any():
+            break
+        sub_parts, sub_index = shapely.get_parts(parts[multi], return_index=True)
+        parts = numpy.concatenate([parts[~multi], sub_parts])
+        index = numpy.concatenate([index[~multi], index[multi][sub_index]])
+
+    # Keep non empty polygons, in the order of the input geometries
+    keep = (shapely.get_type_id(parts) == GeometryType.POLYGON) & ~shapely.is_empty(parts)
+    parts, index = parts[keep], index[keep]
+    order = numpy.argsort(index, kind='mergesort')
+
+    result = numpy.full(len(geoms), None, dtype=object)
+    if len(order):
+        shapely.multipolygons(parts[order], indices=index[order], out=result)
+
+    return result
+
+
+def repair_multipolygon_wkb(wkbs):
+    """
+    Convert an array of WKB geometries into valid MultiPolygons in process,
+    using vectorized shapely operations. Returns a list of WKB geometries,
+    with None for geometries that could not be converted. Requires shapely.
+    """
+    geoms = shapely.from_wkb(numpy.array(wkbs, dtype=object))
+
+    # Geometries that are empty or have no area (point & line) can not be
+    # converted.
+    candidates = ~shapely.is_empty(geoms) & (shapely.area(geoms) > 0)
+
+    # Iteratively convert to valid multi polygons
+    for i in range(MAX_REPAIR_ITERATIONS):
+        multi = shapely.get_type_id(geoms) == GeometryType.MULTIPOLYGON
+        todo = candidates & ~(multi & shapely.is_valid(geoms))
+        if not todo.any():
+            break
+        geoms[todo] = _extract_polygons(shapely.make_valid(geoms[todo]))
+        candidates &= ~shapely.is_missing(geoms)
+
+    # Check if all conditions are statisfied after conversion
+    valid = candidates & ~shapely.is_missing(geoms)
+    valid[valid] = (
+        (shapely.get_type_id(geoms[valid]) == GeometryType.MULTIPOLYGON)
+        & shapely.is_valid(geoms[valid])
+        & ~shapely.is_empty(geoms[valid])
+        & (shapely.area(geoms[valid]) > 0)
+    )
+
+    result = [None] * len(geoms)
+    for idx, wkb in zip(numpy.flatnonzero(valid), shapely.to_wkb(geoms[valid], output_dimension=2)):
+        result[idx] = wkb
+    return result
+
+
+def convert_to_multipolygon_sql(geom):
+    """
+    Convert a geometry into a MultiPolygon using PostGIS for cleaning the
+    geometry. This function will return an empty geometry if conversion is
+    not possible.
+    """
     cursor = connection.cursor()
 
     # Store this geom's srid
@@ -82,3 +187,22 @@ def distance_in_radians(point, distance, srid=WEB_MERCATOR_SRID):
     point_clone.transform(WEB_MERCATOR_SRID)
 
     return point.distance(point_clone)
+
+
+def format_tolerance(tolerance):
+    """
+    Format a simplification tolerance for hashing.
+    """
+    return repr(float(tolerance))
+
+
+def geometry_hash(geom, tolerance=None):
+    """
+    Compute a hash of the WKB representation of a geometry. If a
+    simplification tolerance is given, it is included in the hash, so that
+    the hash changes if the simplified geometry changes.
+    """
+    checksum = hashlib.md5(bytes(geom.wkb))
+    if tolerance is not None:
+        checksum.update(format_tolerance(tolerance).encode())
+    return checksum.hexdigest()
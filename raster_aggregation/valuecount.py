@@ -0,0 +1,704 @@
+import json
+import math
+import zlib
+from collections import Counter, deque
+from itertools import chain, islice
+from multiprocessing.pool import ThreadPool
+
+import numpy
+from raster.algebra.parser import FormulaParser
+from raster.models import Legend, RasterLayer, RasterTile
+from raster.rasterize import rasterize
+from raster.tiles.const import WEB_MERCATOR_TILESIZE
+from raster.tiles.utils import get_raster_tile, tile_bounds, tile_index_range, tile_scale
+
+from django.conf import settings
+from django.contrib.gis.gdal import GDALRaster
+from django.contrib.gis.geos import Polygon
+from raster_aggregation.tilecache import tile_cache
+from raster_aggregation.utils import WEB_MERCATOR_SRID
+
+# Burn all pixels touched by the area geometries when rasterizing.
+ALL_TOUCHED = getattr(settings, 'RASTER_AGGREGATION_ALL_TOUCHED', True)
+
+# Conversion factor from square meters to acres.
+SQUARE_METERS_TO_ACRES = 0.000247105381
+
+# Separator for band indices in layer names, such as "a:1".
+BAND_INDEX_SEPARATOR = ':'
+
+# Number of tiles that are fetched from the database in a single query.
+TILE_BATCH_SIZE = getattr(settings, 'RASTER_AGGREGATION_TILE_BATCH_SIZE', 100)
+
+# Approximate maximum number of bytes of tile data held in memory by an
+# aggregation. The tile batch size is reduced to stay within the budget.
+MEMORY_BUDGET = getattr(settings, 'RASTER_AGGREGATION_MEMORY_BUDGET', 256 * 1024 * 1024)
+
+# Number of tiles for which cached histograms are looked up and stored in a
+# single query.
+HISTOGRAM_WINDOW_SIZE = getattr(settings, 'RASTER_AGGREGATION_HISTOGRAM_WINDOW_SIZE', 1000)
+
+# Number of tile batches that are evaluated in background threads while the
+# next batch is fetched. Set to zero to process the tiles sequentially.
+PREFETCH_DEPTH = getattr(settings, 'RASTER_AGGREGATION_PREFETCH_DEPTH', 2)
+
+
+def parse_grouping(grouping, layers):
+    """
+    Resolve the grouping parameter into 'discrete', 'continuous' or a list of
+    legend expressions.
+    """
+    if grouping == 'auto':
+        all_discrete = all(lyr.datatype in ['ca', 'ma'] for lyr in layers)
+        return 'discrete' if all_discrete else 'continuous'
+    elif grouping in ('discrete', 'continuous'):
+        return grouping
+
+    # Get legend json from legend id or use grouping as legend json
+    try:
+        legend = Legend.objects.get(id=int(grouping))
+        legend = legend.json
+    except (ValueError, TypeError):
+        legend = grouping
+
+    return [entry['expression'] for entry in json.loads(legend)]
+
+
+def group_value_counts(counts, grouping):
+    """
+    Group the pixel counts of discrete values by legend expressions. The
+    expressions are evaluated on the unique values only.
+    """
+    if not counts or not isinstance(grouping, list):
+        return counts
+
+    values = numpy.array(list(counts.keys()), dtype='float64')
+    pixels = numpy.array(list(counts.values()))
+
+    parser = FormulaParser()
+    result = {}
+    for expression in grouping:
+        try:
+            selector = values == float(expression)
+        except ValueError:
+            selector = parser.evaluate({'x': values}, expression)
+        total = pixels[numpy.asarray(selector, dtype='bool')].sum()
+        if total:
+            result[expression] = total
+
+    return result
+
+
+def format_value_counts(counts, zoom, acres=False):
+    """
+    Convert value count keys to strings and pixel counts to acres if
+    requested.
+    """
+    scaling = abs(tile_scale(zoom) ** 2) * SQUARE_METERS_TO_ACRES if acres else 1
+
+    result = {}
+    for key, count in counts.items():
+        if not isinstance(key, str):
+            key = str(int(key)) if float(key).is_integer() else str(key)
+        result[key] = count * scaling if acres else int(count)
+
+    return result
+
+
+def get_tile_template(tilez, tilex, tiley):
+    """
+    Create an empty in memory raster aligned with a tile.
+    """
+    bounds = tile_bounds(tilex, tiley, tilez)
+    scale = tile_scale(tilez)
+    return GDALRaster({
+        'name': '',
+        'driver': 'MEM',
+        'srid': WEB_MERCATOR_SRID,
+        'width': WEB_MERCATOR_TILESIZE,
+        'height': WEB_MERCATOR_TILESIZE,
+        'origin': (bounds[0], bounds[3]),
+        'scale': (scale, -scale),
+        'datatype': 1,
+        'bands': [{'nodata_value': 0}],
+    })
+
+
+def get_tile_geometry(tilez, tilex, tiley):
+    """
+    Get the polygon of a tile in web mercator.
+    """
+    return Polygon.from_bbox(tile_bounds(tilex, tiley, tilez))
+
+
+def get_layers_tile_range(layers, zoom):
+    """
+    Compute the range of tile indices at the given zoom level that is covered
+    by the extents of all raster layers, as [xmin, ymin, xmax, ymax]. The
+    range is empty if the extents do not overlap.
+    """
+    index_ranges = [tile_index_range(lyr.extent(), zoom) for lyr in layers]
+    return [
+        max(index_range[0] for index_range in index_ranges),
+        max(index_range[1] for index_range in index_ranges),
+        min(index_range[2] for index_range in index_ranges),
+        min(index_range[3] for index_range in index_ranges),
+    ]
+
+
+def get_child_tile_range(tilez, tilex, tiley, zoom, tilerange=None):
+    """
+    Compute the range of tile indices at the given zoom level of the children
+    of a tile, as [xmin, ymin, xmax, ymax]. The range is clipped to a tile
+    range if provided.
+    """
+    size = 2 ** (zoom - tilez)
+    childrange = [tilex * size, tiley * size, (tilex + 1) * size - 1, (tiley + 1) * size - 1]
+    if tilerange is not None:
+        childrange = [
+            max(childrange[0], tilerange[0]),
+            max(childrange[1], tilerange[1]),
+            min(childrange[2], tilerange[2]),
+            min(childrange[3], tilerange[3]),
+        ]
+    return childrange
+
+
+def get_tile_coverage_blocks(geom, zoom, tilerange=None):
+    """
+    Generator that yields the zoom level, the tile indices and a fully
+    covered flag of the tiles that cover the geometry at the given zoom
+    level. Fully covered tiles are yielded at the lowest zoom level at which
+    they are covered by the geometry, instead of all their children at the
+    given zoom level.
+
+    The tiles are found by descending the tile pyramid from zoom level zero.
+    Parent tiles that are disjoint from the geometry are skipped, so only
+    tiles along the boundary of the geometry are tested. If a tile range is
+    provided, parent tiles without children in the range are skipped too.
+    """
+    if geom.srid != WEB_MERCATOR_SRID:
+        geom = geom.transform(WEB_MERCATOR_SRID, clone=True)
+    prepared = geom.prepared
+
+    stack = [(0, 0, 0)]
+    while stack:
+        tilez, tilex, tiley = stack.pop()
+        if tilerange is not None:
+            childrange = get_child_tile_range(tilez, tilex, tiley, zoom, tilerange)
+            if childrange[0] > childrange[2] or childrange[1] > childrange[3]:
+                continue
+        tile = get_tile_geometry(tilez, tilex, tiley)
+        if prepared.contains(tile):
+            yield tilez, tilex, tiley, True
+        elif prepared.intersects(tile):
+            if tilez == zoom:
+                yield tilez, tilex, tiley, False
+            else:
+                stack.extend(
+                    (tilez + 1, 2 * tilex + dx, 2 * tiley + dy) for dx in (0, 1) for dy in (0, 1)
+                )
+
+
+def expand_tile_coverage(blocks, zoom, tilerange=None):
+    """
+    Generator that expands tile coverage blocks into the tile indices and
+    fully covered flags of the tiles at the given zoom level. Only tiles
+    within the tile range are yielded if a range is provided.
+    """
+    for tilez, tilex, tiley, fully_covered in blocks:
+        xmin, ymin, xmax, ymax = get_child_tile_range(tilez, tilex, tiley, zoom, tilerange)
+        for childx in range(xmin, xmax + 1):
+            for childy in range(ymin, ymax + 1):
+                yield childx, childy, fully_covered
+
+
+def get_tile_coverage(geom, zoom, tilerange=None):
+    """
+    Generator that yields the tile indices and a fully covered flag for every
+    tile at the given zoom level that intersects with the geometry. All
+    children of parent tiles that are covered by the geometry are covered
+    as well. The coverage is clipped to the tile range if provided.
+    """
+    return expand_tile_coverage(get_tile_coverage_blocks(geom, zoom, tilerange), zoom, tilerange)
+
+
+def split_coverage(coverage, nr_of_parts):
+    """
+    Split a list of tile indices and fully covered flags into parts. The
+    tiles are ordered by blocks of the tile grid, so that every part covers
+    a compact region.
+    """
+    block = 16
+    coverage = sorted(coverage, key=lambda tile: (tile[0] // block, tile[1] // block, tile[0], tile[1]))
+    size = int(math.ceil(len(coverage) / float(nr_of_parts)))
+    return [coverage[start:start + size] for start in range(0, len(coverage), size)]
+
+
+def get_coverage_extent(coverage, zoom):
+    """
+    Compute the extent of a list of tile indices and fully covered flags.
+    """
+    bounds = [tile_bounds(tilex, tiley, zoom) for tilex, tiley, fully_covered in coverage]
+    return (
+        min(bound[0] for bound in bounds),
+        min(bound[1] for bound in bounds),
+        max(bound[2] for bound in bounds),
+        max(bound[3] for bound in bounds),
+    )
+
+
+def get_area_tile_index(areas, zoom, tilerange=None):
+    """
+    Compute the list of intersecting (area id, geometry) pairs for every tile
+    at the given zoom level, within the tile range if provided.
+    """
+    index = {}
+    for area_id, geom in areas:
+        if geom.srid != WEB_MERCATOR_SRID:
+            geom.transform(WEB_MERCATOR_SRID)
+        for tilex, tiley, covered in get_tile_coverage(geom, zoom, tilerange):
+            index.setdefault((tilex, tiley), []).append((area_id, geom))
+    return index
+
+
+def build_label_array(template, areas, all_touched=ALL_TOUCHED):
+    """
+    Rasterize a list of (area id, geometry) pairs into a label array aligned
+    with the template raster. Each label refers to the set of area ids that
+    cover the pixel, so that overlapping areas are supported. Label zero is
+    the empty set. Returns the label array and the list of area id sets.
+    """
+    labels = numpy.zeros(WEB_MERCATOR_TILESIZE * WEB_MERCATOR_TILESIZE, dtype='uint32')
+    label_sets = [()]
+    lookup = {(): 0}
+
+    for area_id, geom in areas:
+        mask = rasterize(geom, template, all_touched=all_touched).bands[0].data().ravel() == 1
+        if not mask.any():
+            continue
+
+        # Extend the area sets of the labels under the mask with this area
+        current = labels[mask]
+        updated = numpy.empty_like(current)
+        for label in numpy.unique(current):
+            key = label_sets[label] + (area_id, )
+            if key not in lookup:
+                lookup[key] = len(label_sets)
+                label_sets.append(key)
+            updated[current == label] = lookup[key]
+        labels[mask] = updated
+
+    return labels, label_sets
+
+
+def build_label_masks(areas, zoom, all_touched=ALL_TOUCHED):
+    """
+    Generator that yields the tile indices, label array and area id sets for
+    every tile intersecting with a list of (area id, geometry) pairs.
+    """
+    for (tilex, tiley), tile_areas in get_area_tile_index(areas, zoom).items():
+        template = get_tile_template(zoom, tilex, tiley)
+        labels, label_sets = build_label_array(template, tile_areas, all_touched)
+        yield tilex, tiley, labels, label_sets
+
+
+def encode_labels(labels):
+    """
+    Compress a label array for storage.
+    """
+    return zlib.compress(labels.astype('uint32').tobytes())
+
+
+def decode_labels(data):
+    """
+    Decompress a stored label array.
+    """
+    return numpy.frombuffer(zlib.decompress(bytes(data)), dtype='uint32')
+
+
+def count_labeled_values(values, labels, label_sets, results):
+    """
+    Count the values per area in a single vectorized pass over a tile. The
+    values are a masked array, the counts are added to the results
+    dictionary of area id and value counters.
+    """
+    selector = ~numpy.ma.getmaskarray(values) & (labels > 0)
+    if not selector.any():
+        return
+
+    values = numpy.ma.getdata(values)[selector]
+    labels = labels[selector]
+
+    # Combine the label and the value index into a single key
+    unique_values, value_index = numpy.unique(values, return_inverse=True)
+    unique_labels, label_index = numpy.unique(labels, return_inverse=True)
+    counts = numpy.bincount(
+        label_index * len(unique_values) + value_index,
+        minlength=len(unique_labels) * len(unique_values),
+    ).reshape(len(unique_labels), len(unique_values))
+
+    for label, label_counts in zip(unique_labels, counts):
+        nonzero = label_counts > 0
+        label_counts = dict(zip(unique_values[nonzero].tolist(), label_counts[nonzero].tolist()))
+        for area_id in label_sets[label]:
+            results.setdefault(area_id, Counter()).update(label_counts)
+
+
+def iterate_chunks(iterable, size):
+    """
+    Generator that yields lists of up to size items from an iterable,
+    without reading the iterable ahead.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def fetch_raster_tiles(layer_id, zoom, tiles):
+    """
+    Get the rasters of a list of tile indices of a raster layer in a single
+    query. Returns a dictionary of rasters by tile index.
+    """
+    if not tiles:
+        return {}
+    tilexs, tileys = zip(*tiles)
+    query = (
+        'SELECT id, tilex, tiley, rast FROM {table} '
+        'WHERE rasterlayer_id = %s AND tilez = %s '
+        'AND (tilex, tiley) IN (SELECT * FROM unnest(%s::integer[], %s::integer[]))'
+    ).format(table=RasterTile._meta.db_table)
+    return {
+        (tile.tilex, tile.tiley): tile.rast
+        for tile in RasterTile.objects.raw(query, [layer_id, zoom, list(tilexs), list(tileys)])
+    }
+
+
+def count_values(values, results):
+    """
+    Count the unmasked values of a masked array, the counts are added to the
+    results counter.
+    """
+    values = values.compressed()
+    if not values.size:
+        return
+    unique_values, counts = numpy.unique(values, return_counts=True)
+    results.update(dict(zip(unique_values.tolist(), counts.tolist())))
+
+
+class TileAggregator(object):
+    """
+    Base class for computing value counts from raster tiles. The tiles of
+    the layers are fetched in batches and the formula is evaluated on the
+    tile data.
+
+    Only discrete and legend groupings are supported.
+    """
+
+    def __init__(self, layer_dict, formula, zoom=None, acres=True, grouping='auto', all_touched=ALL_TOUCHED,
+                 prefetch_depth=PREFETCH_DEPTH, memory_budget=MEMORY_BUDGET):
+        self.layer_dict = layer_dict
+        self.formula = formula
+        self.acres = acres
+        self.all_touched = all_touched
+        self.prefetch_depth = prefetch_depth
+        self.memory_budget = memory_budget
+
+        layers = RasterLayer.objects.filter(id__in=layer_dict.values())
+
+        # Compute zoom if not provided
+        if zoom is None:
+            zoom = min(layers.values_list('metadata__max_zoom', flat=True))
+        self.zoom = zoom
+
+        self.grouping = parse_grouping(grouping, layers)
+
+        # Clip the tiles against the extent of the layers. This limits the
+        # number of tiles for large areas on small rasters.
+        self.tilerange = get_layers_tile_range(layers, zoom)
+
+        # Tiles are cached per version of the layers
+        self.layer_versions = {}
+        if tile_cache is not None:
+            self.layer_versions = {
+                str(layer_id): modified.strftime('%Y%m%d%H%M%S%f')
+                for layer_id, modified in layers.values_list('id', 'modified')
+            }
+
+    @classmethod
+    def supports(cls, grouping, layer_dict):
+        """
+        Check if the grouping can be computed by the aggregator.
+        """
+        layers = RasterLayer.objects.filter(id__in=layer_dict.values())
+        return parse_grouping(grouping, layers) != 'continuous'
+
+    def in_tile_range(self, tilex, tiley):
+        """
+        Check if a tile is within the extent of all layers.
+        """
+        return self.tilerange[0] <= tilex <= self.tilerange[2] and self.tilerange[1] <= tiley <= self.tilerange[3]
+
+    def get_tile_data(self, tilex, tiley):
+        """
+        Get the tile data of every layer as masked arrays. Returns None if the
+        tile is missing in any of the layers.
+        """
+        return self.fetch_tile_data([(tilex, tiley)]).get((tilex, tiley))
+
+    def fetch_tile_data(self, tiles):
+        """
+        Get the tile data for a list of tile indices, with one query per
+        layer. Tiles outside of the extent of the layers are skipped. Tiles
+        within the extent that do not exist at the zoom level are looked up
+        individually, which creates them from lower zoom levels if possible.
+        Decoded bands are read from and written to the tile cache if it is
+        enabled. Returns a dictionary of tile data by tile index, tiles that
+        are missing in any of the layers are omitted.
+        """
+        data = {tile: {} for tile in tiles if self.in_tile_range(*tile)}
+        for name, layer_id in self.layer_dict.items():
+            band = int(name.split(BAND_INDEX_SEPARATOR)[1]) if BAND_INDEX_SEPARATOR in name else 0
+            version = self.layer_versions.get(str(layer_id))
+
+            bands = {}
+            if tile_cache is not None:
+                for tilex, tiley in data:
+                    cached = tile_cache.get(layer_id, self.zoom, tilex, tiley, band, version)
+                    if cached is not None:
+                        bands[(tilex, tiley)] = cached
+
+            missing = [tile for tile in data if tile not in bands]
+            rasters = fetch_raster_tiles(layer_id, self.zoom, missing)
+            for tilex, tiley in missing:
+                rast = rasters.get((tilex, tiley)) or get_raster_tile(layer_id, self.zoom, tilex, tiley)
+                if not rast:
+                    continue
+                tile_band = rast.bands[band]
+                bands[(tilex, tiley)] = (tile_band.data().ravel(), tile_band.nodata_value)
+                if tile_cache is not None:
+                    tile_cache.set(layer_id, self.zoom, tilex, tiley, band, *bands[(tilex, tiley)], version=version)
+
+            for tile in list(data.keys()):
+                if tile not in bands:
+                    del data[tile]
+                    continue
+                values, nodata = bands[tile]
+                data[tile][name] = numpy.ma.masked_array(values) \
+                    if nodata is None else numpy.ma.masked_values(values, nodata, copy=False)
+        return data
+
+    @property
+    def batch_size(self):
+        """
+        Number of tiles fetched per batch, limited such that the batches in
+        the pipeline stay within the memory budget. Each tile is assumed to
+        hold the bands of all layers and the evaluated formula as masked
+        float64 arrays.
+        """
+        tile_bytes = WEB_MERCATOR_TILESIZE ** 2 * 9 * (len(self.layer_dict) + 1)
+        batches = max(self.prefetch_depth, 0) + 1
+        return int(max(1, min(TILE_BATCH_SIZE, self.memory_budget // (tile_bytes * batches))))
+
+    def iterate_tile_batches(self, tiles):
+        """
+        Generator that yields lists of tile indices and tile data for an
+        iterable of tile indices, fetching the tiles in batches. The tile
+        indices are consumed lazily.
+        """
+        for batch in iterate_chunks(tiles, self.batch_size):
+            data = self.fetch_tile_data(batch)
+            yield [(tile, data[tile]) for tile in batch if tile in data]
+
+    def process_tiles(self, tiles, func):
+        """
+        Generator that yields the results of a function applied to the tile
+        index and tile data of every tile in a list of tile indices.
+
+        The tiles are fetched on the calling thread, as database connections
+        are thread local. Fetched batches are processed in a thread pool,
+        so that the database queries for the next batch overlap with the
+        evaluation of the current batches. The number of batches in memory
+        is bounded by the prefetch depth.
+        """
+        if self.prefetch_depth < 1:
+            for batch in self.iterate_tile_batches(tiles):
+                for tile, data in batch:
+                    yield func(tile, data)
+            return
+
+        pool = ThreadPool(self.prefetch_depth)
+        pending = deque()
+        try:
+            for batch in self.iterate_tile_batches(tiles):
+                pending.append(pool.map_async(lambda item: func(*item), batch))
+                # Wait for the oldest batch if the pipeline is full
+                while len(pending) > self.prefetch_depth:
+                    for result in pending.popleft().get():
+                        yield result
+            while pending:
+                for result in pending.popleft().get():
+                    yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def evaluate(self, data):
+        """
+        Evaluate the formula on the tile data.
+        """
+        return numpy.ma.ravel(FormulaParser().evaluate(data, self.formula))
+
+    def format(self, counts):
+        """
+        Group and format the value counts of an area.
+        """
+        return format_value_counts(group_value_counts(counts, self.grouping), self.zoom, self.acres)
+
+
+class LayerAggregator(TileAggregator):
+    """
+    Compute value counts for many aggregation areas in a single pass over the
+    raster tiles. Each tile is loaded and evaluated once, and all areas that
+    intersect with the tile are counted together.
+
+    Precomputed label masks can be provided as an iterable of tile indices,
+    compressed label arrays and area id sets, in which case the areas are not
+    rasterized. The label arrays are decoded tile by tile during counting.
+    """
+
+    def __init__(self, areas, layer_dict, formula, zoom=None, acres=True, grouping='auto',
+                 all_touched=ALL_TOUCHED, label_masks=None, prefetch_depth=PREFETCH_DEPTH, memory_budget=MEMORY_BUDGET):
+        super(LayerAggregator, self).__init__(
+            layer_dict, formula, zoom, acres, grouping, all_touched, prefetch_depth, memory_budget,
+        )
+        self.areas = [(area.id, area.geom) for area in areas]
+        self.label_masks = label_masks
+
+    def value_counts(self):
+        """
+        Compute the value counts of all areas. Returns a dictionary with the
+        formatted value counts by area id.
+        """
+        if self.label_masks is None:
+            index = get_area_tile_index(self.areas, self.zoom, self.tilerange)
+
+            def get_labels(tilex, tiley):
+                template = get_tile_template(self.zoom, tilex, tiley)
+                return build_label_array(template, index[(tilex, tiley)], self.all_touched)
+        else:
+            area_ids = set(area_id for area_id, geom in self.areas)
+            # Skip tiles without any of the requested areas or outside of
+            # the extent of the layers
+            index = {
+                (tilex, tiley): (labels, label_sets)
+                for tilex, tiley, labels, label_sets in self.label_masks
+                if self.in_tile_range(tilex, tiley) and not area_ids.isdisjoint(chain.from_iterable(label_sets))
+            }
+
+            def get_labels(tilex, tiley):
+                labels, label_sets = index[(tilex, tiley)]
+                return decode_labels(labels), label_sets
+
+        def count_tile(tile, data):
+            labels, label_sets = get_labels(*tile)
+            counts = {}
+            count_labeled_values(self.evaluate(data), labels, label_sets, counts)
+            return counts
+
+        results = {}
+        for counts in self.process_tiles(index.keys(), count_tile):
+            for area_id, area_counts in counts.items():
+                results.setdefault(area_id, Counter()).update(area_counts)
+
+        return {area_id: self.format(results.get(area_id, {})) for area_id, geom in self.areas}
+
+
+class AreaAggregator(TileAggregator):
+    """
+    Compute value counts for a single geometry. The tiles are selected from
+    a list of tile indices and fully covered flags, such as the precomputed
+    tile coverage of an aggregation area, clipped to the extent of the
+    layers. Tiles that are fully covered by the geometry are counted without
+    rasterizing the geometry.
+
+    A histogram cache can be provided to reuse the value counts of fully
+    covered tiles. The cache needs a get_many method that returns the
+    cached histograms for a list of tile indices and a set_many method that
+    stores a dictionary of histograms by tile index.
+    """
+
+    def __init__(self, geom, layer_dict, formula, zoom=None, acres=True, grouping='auto',
+                 all_touched=ALL_TOUCHED, coverage=None, histograms=None, prefetch_depth=PREFETCH_DEPTH,
+                 memory_budget=MEMORY_BUDGET):
+        super(AreaAggregator, self).__init__(
+            layer_dict, formula, zoom, acres, grouping, all_touched, prefetch_depth, memory_budget,
+        )
+        if geom.srid != WEB_MERCATOR_SRID:
+            geom = geom.transform(WEB_MERCATOR_SRID, clone=True)
+        self.geom = geom
+        self.coverage = coverage
+        self.histograms = histograms
+
+    def value_count(self):
+        """
+        Compute the formatted value counts of the geometry.
+        """
+        return self.format(self.count())
+
+    def count(self):
+        """
+        Compute the pixel counts of the values in the geometry, before
+        grouping and formatting.
+        """
+        coverage = self.coverage
+        if coverage is None:
+            coverage = get_tile_coverage(self.geom, self.zoom, self.tilerange)
+        covered = {
+            (tilex, tiley): fully_covered for tilex, tiley, fully_covered in coverage
+            if self.in_tile_range(tilex, tiley)
+        }
+
+        # Only running value counts are kept, the tiles are streamed through
+        # the pipeline in batches.
+        results = Counter()
+        computed = {}
+
+        def iterate_tiles():
+            for window in iterate_chunks(covered.items(), HISTOGRAM_WINDOW_SIZE):
+                # Add up cached histograms of fully covered tiles
+                cached = {}
+                if self.histograms is not None:
+                    cached = self.histograms.get_many([tile for tile, fully_covered in window if fully_covered])
+                    for histogram in cached.values():
+                        results.update(histogram)
+                for tile, fully_covered in window:
+                    if tile not in cached:
+                        yield tile
+
+        def count_tile(tile, data):
+            values = self.evaluate(data)
+            if not covered[tile]:
+                template = get_tile_template(self.zoom, *tile)
+                mask = rasterize(self.geom, template, all_touched=self.all_touched).bands[0].data().ravel() != 1
+                values = numpy.ma.masked_where(mask, values)
+            histogram = Counter()
+            count_values(values, histogram)
+            return tile, histogram
+
+        for tile, histogram in self.process_tiles(iterate_tiles(), count_tile):
+            results.update(histogram)
+            if covered[tile] and self.histograms is not None:
+                computed[tile] = histogram
+                # Store computed histograms in windows
+                if len(computed) >= HISTOGRAM_WINDOW_SIZE:
+                    self.histograms.set_many(computed)
+                    computed = {}
+
+        if computed:
+            self.histograms.set_many(computed)
+
+        return results
@@ -1,13 +1,53 @@
-from rest_framework import filters, viewsets
+import hashlib
+
+from rest_framework import filters, status, viewsets
+from rest_framework.decorators import detail_route
 from rest_framework.exceptions import APIException
+from rest_framework.renderers import BrowsableAPIRenderer
+from rest_framework.response import Response
 from rest_framework_extensions.cache.decorators import cache_response
+from rest_framework_extensions.etag.decorators import etag
 from rest_framework_gis.filters import InBBOXFilter
 
-from .models import AggregationArea, AggregationLayer
+from django.conf import settings
+from django.contrib.gis.db.models.functions import AsGeoJSON, Transform
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db.models.expressions import RawSQL
+from django.db.models.fields import TextField
+from django.http import HttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.generic import View
+
+from .caching import (
+    RESULTS_GENERATION, calculate_cache_key, calculate_etag, get_generations, get_layer_generation_name,
+    normalize_query
+)
+from .models import AggregationArea, AggregationAreaSimplification, AggregationLayer, ValueCountJob, ValueCountResult
+from .renderers import RawJSONRenderer
 from .serializers import (
     AggregationAreaGeoSerializer, AggregationAreaSimplifiedSerializer, AggregationAreaValueSerializer,
-    AggregationLayerSerializer
+    AggregationLayerSerializer, ValueCountJobSerializer, parse_value_count_parameters
 )
+from .tasks import compute_single_value_count_result
+
+# Spatial reference of the geometries in api responses.
+WGS84_SRID = 4326
+
+# Number of seconds after which a pending asynchronous value count is
+# enqueued again if its result is still missing. Failed computations are
+# enqueued again by the next status request.
+ASYNC_PENDING_TIMEOUT = getattr(settings, 'RASTER_AGGREGATION_ASYNC_PENDING_TIMEOUT', 600)
+
+# Number of seconds vector tiles are cached. Tiles are invalidated when the
+# aggregation layer is modified, embedded value counts are updated when the
+# tile expires.
+VECTOR_TILE_CACHE_TIMEOUT = getattr(settings, 'RASTER_AGGREGATION_VECTOR_TILE_CACHE_TIMEOUT', 3600)
+
+VECTOR_TILE_CONTENT_TYPE = 'application/vnd.mapbox-vector-tile'
+
+# Highest zoom level accepted in query parameters.
+MAX_ZOOM_LEVEL = 30
 
 
 class MissingQueryParameter(APIException):
@@ -15,45 +55,84 @@ class MissingQueryParameter(APIException):
     default_detail = 'Missing Query Parameter.'
 
 
+class InvalidQueryParameter(APIException):
+    status_code = 400
+    default_detail = 'Invalid Query Parameter.'
+
+
+def get_zoom_parameter(request):
+    """
+    Get the zoom level from the query parameters, returns None if it is not
+    provided.
+    """
+    zoom = request.query_params.get('zoom')
+    if not zoom:
+        return
+    try:
+        zoom = int(zoom)
+    except ValueError:
+        zoom = None
+    if zoom is None or not 0 <= zoom <= MAX_ZOOM_LEVEL:
+        raise InvalidQueryParameter('Zoom must be an integer from 0 to {0}.'.format(MAX_ZOOM_LEVEL))
+    return zoom
+
+
 class AggregationAreaViewSet(viewsets.ReadOnlyModelViewSet):
     """
     Regular aggregation Area model view endpoint.
     """
     serializer_class = AggregationAreaSimplifiedSerializer
     filter_fields = ('aggregationlayer', )
+    renderer_classes = (RawJSONRenderer, BrowsableAPIRenderer)
 
     def get_queryset(self):
-        qs = AggregationArea.objects.all()
+        # Generate the rounded GeoJSON of the simplified geometries in the
+        # database, the geometry columns are not loaded. If a zoom level is
+        # requested, the geometries simplified for its zoom band are used.
+        zoom = get_zoom_parameter(self.request)
+        if zoom is not None:
+            sql, params = AggregationArea.get_simplified_geometry_sql(zoom)
+            geom_geojson = RawSQL(
+                'ST_AsGeoJSON(ST_Transform({0}, {1}), 4)'.format(sql, WGS84_SRID), params,
+                output_field=TextField(),
+            )
+        else:
+            geom_geojson = AsGeoJSON(Transform('geom_simplified', WGS84_SRID), precision=4)
+
+        qs = AggregationArea.objects.defer('geom', 'geom_simplified').annotate(geom_geojson=geom_geojson)
         ids = self.request.query_params.get('ids')
         if ids:
             qs = qs.filter(id__in=ids.split(','))
         return qs
 
+    @etag(etag_func='calculate_etag')
     @cache_response(key_func='calculate_cache_key')
     def list(self, request, *args, **kwargs):
         """
-        List method wrapped with caching decorator.
+        List method wrapped with caching and etag decorators.
         """
         return super(AggregationAreaViewSet, self).list(request, *args, **kwargs)
 
-    def calculate_cache_key(self, view_instance, view_method, request, *args, **kwargs):
+    @etag(etag_func='calculate_etag')
+    def retrieve(self, request, *args, **kwargs):
         """
-        Creates the cache key based on query parameters and change dates from
-        related objects.
+        Retrieve method wrapped with etag decorator.
         """
-        # Add ids to cache key data
-        cache_key_data = [
-            request.GET.get('ids', '')
-        ]
+        return super(AggregationAreaViewSet, self).retrieve(request, *args, **kwargs)
 
-        # Add aggregationlayer id and modification date
-        agglayer_id = request.GET.get('aggregationlayer', '')
-        if agglayer_id:
-            modified = AggregationLayer.objects.get(id=agglayer_id).modified
-            modified = str(modified).replace(' ', '-')
-            cache_key_data.append('-'.join(['agg', agglayer_id, modified]))
+    def calculate_cache_key(self, view_instance, view_method, request, *args, **kwargs):
+        """
+        Creates the cache key based on query parameters and the generation
+        counters of the aggregation layers.
+        """
+        return calculate_cache_key('raster_aggregation_area', view_method, request, extra=[kwargs.get('pk', '')])
 
-        return '|'.join(cache_key_data)
+    def calculate_etag(self, view_instance, view_method, request, *args, **kwargs):
+        """
+        Creates the etag from the same data as the cache key, so that
+        conditional requests do not need a database query.
+        """
+        return calculate_etag('raster_aggregation_area', view_method, request, extra=[kwargs.get('pk', '')])
 
 
 class AggregationAreaValueViewSet(viewsets.ReadOnlyModelViewSet):
@@ -75,13 +154,116 @@ class AggregationAreaValueViewSet(viewsets.ReadOnlyModelViewSet):
         return super(AggregationAreaValueViewSet, self).initial(request, *args, **kwargs)
 
     def get_queryset(self):
-        qs = AggregationArea.objects.all()
+        # Only the id is serialized, geometries are not loaded
+        qs = AggregationArea.objects.only('id')
         ids = self.request.query_params.get('ids')
         if ids:
             ids = ids.split(',')
             return qs.filter(id__in=ids)
         return qs
 
+    def get_serializer_context(self):
+        """
+        Parse the value count parameters once per request.
+        """
+        context = super(AggregationAreaValueViewSet, self).get_serializer_context()
+        if not hasattr(self, 'value_count_parameters'):
+            self.value_count_parameters = parse_value_count_parameters(self.request)
+        context['value_count_parameters'] = self.value_count_parameters
+        return context
+
+    @etag(etag_func='calculate_etag')
+    @cache_response(key_func='calculate_cache_key')
+    def list(self, request, *args, **kwargs):
+        """
+        List the value counts of the areas. The existing results of all areas
+        on the page are fetched in a single query and missing results are
+        computed together.
+        """
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        areas = list(queryset) if page is None else page
+
+        context = self.get_serializer_context()
+        context['value_count_results'] = ValueCountResult.objects.get_or_compute_many(
+            [area.id for area in areas], **context['value_count_parameters']
+        )
+        serializer = self.get_serializer_class()(areas, many=True, context=context)
+
+        if page is not None:
+            return self.get_paginated_response(serializer.data)
+        return Response(serializer.data)
+
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Retrieve the value count of an area. With the async query parameter,
+        missing results are computed asynchronously.
+        """
+        if 'async' in request.GET:
+            return self.status(request, *args, **kwargs)
+        return self.retrieve_value(request, *args, **kwargs)
+
+    @etag(etag_func='calculate_etag')
+    @cache_response(key_func='calculate_cache_key')
+    def retrieve_value(self, request, *args, **kwargs):
+        """
+        Retrieve method wrapped with caching and etag decorators.
+        Asynchronous requests are not cached and have no etag, as their
+        response changes when the pending result is computed.
+        """
+        return super(AggregationAreaValueViewSet, self).retrieve(request, *args, **kwargs)
+
+    def calculate_cache_key(self, view_instance, view_method, request, *args, **kwargs):
+        """
+        Creates the cache key based on the normalized value count parameters,
+        the requested area and the generation counters of the aggregation
+        layers and the value count results.
+        """
+        return calculate_cache_key(
+            'raster_aggregation_value', view_method, request,
+            extra=[kwargs.get('pk', '')], generations=[RESULTS_GENERATION],
+        )
+
+    def calculate_etag(self, view_instance, view_method, request, *args, **kwargs):
+        """
+        Creates the etag from the same data as the cache key, so that
+        conditional requests do not need a database query.
+        """
+        return calculate_etag(
+            'raster_aggregation_value', view_method, request,
+            extra=[kwargs.get('pk', '')], generations=[RESULTS_GENERATION],
+        )
+
+    @detail_route(methods=['get'])
+    def status(self, request, *args, **kwargs):
+        """
+        Return the value count of an area if it exists. Otherwise, enqueue its
+        computation and return a 202 response with the url of this status
+        endpoint for polling.
+        """
+        area = self.get_object()
+        params = self.get_serializer_context()['value_count_parameters']
+
+        if ValueCountResult.objects.filter(aggregationarea=area, **params).exists():
+            return super(AggregationAreaValueViewSet, self).retrieve(request, *args, **kwargs)
+
+        # Enqueue the computation unless it is already pending
+        pending_key = 'raster_aggregation_pending_{0}'.format(
+            ValueCountResult.objects.get_lock_key(area, **params)
+        )
+        if cache.add(pending_key, True, ASYNC_PENDING_TIMEOUT):
+            compute_single_value_count_result.delay(
+                area.id, params['formula'], request.GET.get('layers'), params['zoom'],
+                params['units'], params['grouping'], pending_key=pending_key,
+            )
+
+        query = request.GET.copy()
+        query.pop('async', None)
+        url = request.build_absolute_uri(
+            '{0}?{1}'.format(reverse('aggregationareavalue-status', kwargs={'pk': area.id}), query.urlencode())
+        )
+        return Response({'id': area.id, 'status': 'pending', 'url': url}, status=status.HTTP_202_ACCEPTED)
+
 
 class AggregationAreaGeoViewSet(viewsets.ReadOnlyModelViewSet):
     """
@@ -97,11 +279,97 @@ class AggregationAreaGeoViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         queryset = AggregationArea.objects.all()
-        zoom = self.request.QUERY_PARAMS.get('zoom', None)
-        if zoom:
+        zoom = get_zoom_parameter(self.request)
+        if zoom is not None:
             queryset = queryset.filter(aggregationlayer__min_zoom_level__lte=zoom, aggregationlayer__max_zoom_level__gte=zoom)
         return queryset
 
+    def get_serializer(self, *args, **kwargs):
+        """
+        Serialize the geometries simplified for the zoom band of the requested
+        zoom level. The geometries of all areas are fetched in one query,
+        areas without a simplification keep their simplified geometry.
+        """
+        zoom = get_zoom_parameter(self.request)
+        if zoom is None or not args:
+            return super(AggregationAreaGeoViewSet, self).get_serializer(*args, **kwargs)
+
+        areas = list(args[0]) if kwargs.get('many') else [args[0]]
+        simplifications = AggregationAreaSimplification.objects.filter(
+            aggregationarea__in=[area.id for area in areas],
+            min_zoom__lte=zoom,
+            max_zoom__gte=zoom,
+        ).values_list('aggregationarea_id', 'geom')
+        geoms = dict(simplifications)
+        for area in areas:
+            area.geom_simplified = geoms.get(area.id, area.geom_simplified)
+
+        instance = areas if kwargs.get('many') else areas[0]
+        return super(AggregationAreaGeoViewSet, self).get_serializer(instance, *args[1:], **kwargs)
+
+    @etag(etag_func='calculate_etag')
+    def list(self, request, *args, **kwargs):
+        """
+        List method wrapped with etag decorator.
+        """
+        return super(AggregationAreaGeoViewSet, self).list(request, *args, **kwargs)
+
+    @etag(etag_func='calculate_etag')
+    def retrieve(self, request, *args, **kwargs):
+        """
+        Retrieve method wrapped with etag decorator.
+        """
+        return super(AggregationAreaGeoViewSet, self).retrieve(request, *args, **kwargs)
+
+    def calculate_etag(self, view_instance, view_method, request, *args, **kwargs):
+        """
+        Creates the etag based on query parameters and the generations of the
+        aggregation layers.
+        """
+        return calculate_etag('raster_aggregation_geo', view_method, request, extra=[kwargs.get('pk', '')])
+
+
+class AggregationLayerVectorTileView(View):
+    """
+    Mapbox vector tiles of the aggregation areas of a layer. Tiles outside of
+    the zoom range of the layer are empty. The value count results of the
+    areas are embedded if the formula and layers query parameters are given.
+    """
+
+    def get(self, request, layer, z, x, y):
+        z, x, y = int(z), int(x), int(y)
+        embed_values = 'formula' in request.GET and 'layers' in request.GET
+
+        key = self.get_cache_key(request, layer, z, x, y, embed_values)
+        tile = cache.get(key)
+        if tile is None:
+            agglayer = get_object_or_404(AggregationLayer, id=layer)
+            if agglayer.min_zoom_level <= z <= agglayer.max_zoom_level:
+                params = parse_value_count_parameters(request) if embed_values else None
+                tile = agglayer.get_vector_tile(z, x, y, params)
+            else:
+                tile = b''
+            cache.set(key, tile, VECTOR_TILE_CACHE_TIMEOUT)
+
+        if not tile:
+            return HttpResponse(status=status.HTTP_204_NO_CONTENT)
+        return HttpResponse(tile, content_type=VECTOR_TILE_CONTENT_TYPE)
+
+    def get_cache_key(self, request, layer, z, x, y, embed_values):
+        """
+        Creates the cache key from the tile index, the query parameters and
+        the generation counters of the layer and of the value count results
+        if they are embedded.
+        """
+        names = [get_layer_generation_name(layer)]
+        if embed_values:
+            names.append(RESULTS_GENERATION)
+
+        cache_key_data = [layer, z, x, y, normalize_query(request.GET)] + get_generations(names)
+        return 'raster_aggregation_mvt_{0}'.format(
+            hashlib.md5('|'.join(str(item) for item in cache_key_data).encode()).hexdigest()
+        )
+
 
 class AggregationLayerViewSet(viewsets.ReadOnlyModelViewSet):
 
@@ -109,3 +377,14 @@ class AggregationLayerViewSet(viewsets.ReadOnlyModelViewSet):
 
     def get_queryset(self):
         return AggregationLayer.objects.all()
+
+
+class ValueCountJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """
+    API endpoint for the progress of layer wide value count jobs.
+    """
+    serializer_class = ValueCountJobSerializer
+    filter_fields = ('aggregationlayer', 'status')
+
+    def get_queryset(self):
+        return ValueCountJob.objects.all()
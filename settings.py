@@ -36,3 +36,10 @@ TEMPLATES = [
 ]
 
 ROOT_URLCONF = 'raster_aggregation.urls'
+
+# Zoom level of the test raster at which aggregation indexes are built.
+RASTER_AGGREGATION_LABEL_MASK_ZOOMS = (11, )
+RASTER_AGGREGATION_TILE_COVERAGE_ZOOMS = (11, )
+
+# The tests run in a single process, the local memory cache is shared.
+RASTER_AGGREGATION_GENERATION_COUNTERS = True
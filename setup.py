@@ -26,6 +26,9 @@ setup(
         'djangorestframework-gis>=0.11',
         'drf-extensions>=0.3.1',
     ],
+    extras_require={
+        'repair': ['shapely>=2.0'],
+    },
     keywords=['django', 'raster', 'gis', 'gdal', 'celery', 'geo', 'spatial'],
     classifiers=[
         'Environment :: Web Environment',
@@ -1,11 +1,23 @@
 import json
 
 from raster.models import RasterLayer
+from rest_framework.test import APIRequestFactory
+from rest_framework.utils.encoders import JSONEncoder
 
+from django.core.cache import cache
 from django.core.urlresolvers import reverse_lazy as reverse
+from django.db import connection
 from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
 from django.utils.http import urlquote
-from raster_aggregation.models import AggregationArea, ValueCountResult
+from raster_aggregation.caching import (
+    AREAS_GENERATION, RESULTS_GENERATION, generations_are_reliable, get_database_generation, get_generations,
+    get_layer_generation_name, use_generation_counters
+)
+from raster_aggregation.models import AggregationArea, AggregationAreaSimplification, ValueCountResult
+from raster_aggregation.serializers import AggregationAreaSimplifiedSerializer
+from raster_aggregation.tasks import compute_single_value_count_result, compute_value_count_for_aggregation_layer
+from raster_aggregation.views import AggregationAreaViewSet
 
 from .aggregation_testcase import RasterAggregationTestCase
 
@@ -199,3 +211,212 @@ class RasterAggregationApiTests(RasterAggregationTestCase):
             ValueCountResult.objects.filter(aggregationarea=self.area).first().zoom,
             3
         )
+
+    def test_value_count_job_api(self):
+        job_id = compute_value_count_for_aggregation_layer(self.agglayer.id, self.rasterlayer.id)
+        response = self.client.get(reverse('valuecountjob-detail', kwargs={'pk': job_id}))
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.content.strip().decode())
+        self.assertEqual(result['status'], 'finished')
+        self.assertEqual((result['total'], result['done'], result['failed']), (2, 2, 0))
+
+    def test_aggregation_api_async(self):
+        layers = 'a={0}'.format(self.rasterlayer.id)
+        query = '?layers={0}&formula=a&zoom=11&async'.format(layers)
+
+        # Mark the computation as pending, so that it is not enqueued
+        key = ValueCountResult.objects.get_lock_key(self.area, 'a', {'a': self.rasterlayer.id}, 11)
+        cache.set('raster_aggregation_pending_{0}'.format(key), True)
+
+        response = self.client.get(self.url + query)
+        self.assertEqual(response.status_code, 202)
+        result = json.loads(response.content.strip().decode())
+        self.assertEqual(result['status'], 'pending')
+        self.assertTrue('/status/' in result['url'])
+        self.assertFalse('async' in result['url'])
+
+        # Compute the result as the worker would, the status url returns the value
+        compute_single_value_count_result(self.area.id, 'a', layers, 11, '')
+        response = self.client.get(result['url'])
+        self.assertEqual(response.status_code, 200)
+        self.assertDictEqual(json.loads(response.content.strip().decode())['value'], self.expected)
+
+    def test_failed_async_value_count_is_enqueued_again(self):
+        key = 'raster_aggregation_pending_{0}'.format(
+            ValueCountResult.objects.get_lock_key(self.area, 'a', {'a': self.rasterlayer.id}, 11)
+        )
+        cache.set(key, True)
+
+        # The pending key is removed when the computation fails
+        with self.assertRaises(AggregationArea.DoesNotExist):
+            compute_single_value_count_result(-1, 'a', 'a={0}'.format(self.rasterlayer.id), 11, '', pending_key=key)
+        self.assertIsNone(cache.get(key))
+
+    def test_aggregation_api_list_queries_do_not_grow_with_areas(self):
+        areas = AggregationArea.objects.filter(aggregationlayer=self.agglayer)
+        url = reverse('aggregationareavalue-list') + '?layers=a={0}&formula=a&ids={1}'
+
+        # Compute all results in a single request
+        response = self.client.get(url.format(self.rasterlayer.id, ','.join(str(area.id) for area in areas)))
+        self.assertEqual(response.status_code, 200)
+        result = {item['id']: item['value'] for item in json.loads(response.content.strip().decode())}
+        self.assertDictEqual(result[self.area.id], self.expected)
+        self.assertEqual(ValueCountResult.objects.filter(aggregationarea__in=areas).count(), areas.count())
+
+        # Warm list requests need the same number of queries for one or all
+        # areas, the response cache is cleared so that both are computed.
+        cache.clear()
+        with CaptureQueriesContext(connection) as single:
+            self.client.get(url.format(self.rasterlayer.id, self.area.id))
+        cache.clear()
+        with CaptureQueriesContext(connection) as multiple:
+            self.client.get(url.format(self.rasterlayer.id, ','.join(str(area.id) for area in areas)))
+        self.assertEqual(len(single), len(multiple))
+
+    def test_aggregation_api_response_caching(self):
+        url = self.url + '?layers=a={0}&formula=a&zoom=11&grouping={1}'.format(self.rasterlayer.id, self.legend_exp.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ValueCountResult.objects.filter(aggregationarea=self.area).count(), 1)
+
+        # Cached responses are returned without computing the result again
+        ValueCountResult.objects.all().delete()
+        self.assertEqual(self.client.get(url).content, response.content)
+        self.assertEqual(ValueCountResult.objects.filter(aggregationarea=self.area).count(), 0)
+
+        # A legend change invalidates the cached response
+        self.legend_exp.save()
+        self.assertEqual(self.client.get(url).content, response.content)
+        self.assertEqual(ValueCountResult.objects.filter(aggregationarea=self.area).count(), 1)
+
+    def test_aggregation_api_cache_hit_without_queries(self):
+        url = self.url + '?layers=a={0}&formula=a&acres'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        # The same request with reordered parameters is served from the cache
+        url = self.url + '?acres&formula= a &layers=a={0}'.format(self.rasterlayer.id)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(url).content, response.content)
+
+    def test_generation_counters_bumped_on_area_change(self):
+        names = [get_layer_generation_name(self.agglayer.id), AREAS_GENERATION]
+        before = get_generations(names)
+        self.area.save()
+        after = get_generations(names)
+        self.assertTrue(all(new > old for new, old in zip(after, before)))
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'}})
+    def test_generations_not_reliable_without_shared_cache(self):
+        # The counters in a dummy or process local cache are not shared
+        self.assertFalse(use_generation_counters(counters=None))
+        self.assertFalse(generations_are_reliable(counters=None, database=False))
+        # Unless the generations are derived from the database
+        self.assertTrue(generations_are_reliable(counters=None, database=True))
+
+    def test_database_generations_change_on_area_change(self):
+        names = [get_layer_generation_name(self.agglayer.id), AREAS_GENERATION, RESULTS_GENERATION]
+        before = [get_database_generation(name) for name in names]
+        self.area.save()
+        after = [get_database_generation(name) for name in names]
+        self.assertNotEqual(after[0], before[0])
+        self.assertNotEqual(after[1], before[1])
+        self.assertEqual(after[2], before[2])
+
+        # Deleting an area changes the generation of its layer
+        AggregationArea.objects.filter(name='St Petersburg').delete()
+        self.assertNotEqual(get_database_generation(names[0]), after[0])
+
+    def test_aggregation_api_conditional_request(self):
+        url = self.url + '?layers=a={0}&formula=a&zoom=11'.format(self.rasterlayer.id)
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.has_header('ETag'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # The etag changes with the request parameters
+        response = self.client.get(url + '&acres', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+    def test_aggregation_api_etag_changes_after_value_count_job(self):
+        url = self.url + '?layers=a={0}&formula=a&zoom=11'.format(self.rasterlayer.id)
+        etag = self.client.get(url)['ETag']
+
+        compute_value_count_for_aggregation_layer(self.agglayer.id, self.rasterlayer.id, compute_area=False)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    def test_aggregation_area_geojson_from_database(self):
+        view = AggregationAreaViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get('/', {'ids': self.area.id})
+        response = view(request)
+        response.render()
+        result = json.loads(response.content.strip().decode())[0]
+
+        # The database geojson matches the rounded geometry of the python serializer
+        expected = json.loads(json.dumps(AggregationAreaSimplifiedSerializer(self.area).data, cls=JSONEncoder))
+        self.assertEqual(result['id'], expected['id'])
+        self.assertEqual(result['geom']['type'], expected['geom']['type'])
+        self.assertEqual(len(result['geom']['coordinates']), len(expected['geom']['coordinates']))
+        for polygon, expected_polygon in zip(result['geom']['coordinates'], expected['geom']['coordinates']):
+            self.assertEqual(len(polygon), len(expected_polygon))
+            for ring, expected_ring in zip(polygon, expected_polygon):
+                self.assertEqual(ring, expected_ring)
+
+    def test_aggregation_area_geojson_for_zoom_band(self):
+        band = AggregationAreaSimplification.objects.get(aggregationarea=self.area, min_zoom__lte=3, max_zoom__gte=3)
+        band.geom.transform(4326)
+
+        view = AggregationAreaViewSet.as_view({'get': 'list'})
+        request = APIRequestFactory().get('/', {'ids': self.area.id, 'zoom': 3})
+        response = view(request)
+        response.render()
+        result = json.loads(response.content.strip().decode())[0]
+
+        # The geometry of the zoom band is served
+        self.assertEqual(
+            sum(len(ring) for polygon in result['geom']['coordinates'] for ring in polygon),
+            band.geom.num_coords,
+        )
+
+    def test_aggregation_area_invalid_zoom(self):
+        view = AggregationAreaViewSet.as_view({'get': 'list'})
+        for zoom in ('abc', -1, 99999999999):
+            response = view(APIRequestFactory().get('/', {'ids': self.area.id, 'zoom': zoom}))
+            self.assertEqual(response.status_code, 400)
+
+    def test_aggregation_layer_vector_tile(self):
+        url = reverse('aggregationlayer-vectortile', kwargs={'layer': self.area.aggregationlayer_id, 'z': 0, 'x': 0, 'y': 0})
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/vnd.mapbox-vector-tile')
+        self.assertTrue(len(response.content) > 0)
+
+        # The tile is served from the cache without queries
+        with CaptureQueriesContext(connection) as queries:
+            cached = self.client.get(url)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(cached.content, response.content)
+
+    def test_aggregation_layer_vector_tile_outside_zoom_range(self):
+        self.agglayer.min_zoom_level = 1
+        self.agglayer.save()
+        url = reverse('aggregationlayer-vectortile', kwargs={'layer': self.agglayer.id, 'z': 0, 'x': 0, 'y': 0})
+        self.assertEqual(self.client.get(url).status_code, 204)
+
+        # Saving the layer invalidates the cached tiles
+        self.agglayer.min_zoom_level = 0
+        self.agglayer.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    def test_aggregation_layer_vector_tile_with_values(self):
+        # Compute a value count result to embed
+        response = self.client.get(self.url + '?layers=a={0}&formula=a&zoom=3'.format(self.rasterlayer.id))
+        self.assertEqual(response.status_code, 200)
+
+        url = reverse('aggregationlayer-vectortile', kwargs={'layer': self.area.aggregationlayer_id, 'z': 0, 'x': 0, 'y': 0})
+        response = self.client.get(url + '?layers=a={0}&formula=a&zoom=3'.format(self.rasterlayer.id))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(len(response.content) > 0)
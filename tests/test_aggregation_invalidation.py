@@ -1,4 +1,4 @@
-from raster_aggregation.models import ValueCountResult
+from raster_aggregation.models import TileValueCount, TileValueCountCache, ValueCountResult
 from raster_aggregation.tasks import aggregation_layer_parser, compute_value_count_for_aggregation_layer
 
 from .aggregation_testcase import RasterAggregationTestCase
@@ -9,7 +9,7 @@ class RasterAggregationInvalidationTests(RasterAggregationTestCase):
     def setUp(self):
         super(RasterAggregationInvalidationTests, self).setUp()
 
-        compute_value_count_for_aggregation_layer(self.agglayer, self.rasterlayer.id, compute_area=False, grouping=self.legend_exp.id)
+        compute_value_count_for_aggregation_layer(self.agglayer.id, self.rasterlayer.id, compute_area=False, grouping=self.legend_exp.id)
 
     def test_invalidation_from_reparsing_agglayer(self):
         self.assertEqual(ValueCountResult.objects.all().count(), 2)
@@ -28,7 +28,58 @@ class RasterAggregationInvalidationTests(RasterAggregationTestCase):
         # Assert that value count results have been deleted
         self.assertEqual(ValueCountResult.objects.all().count(), 0)
 
+    def test_tile_histograms_invalidated_from_reparsing_rasterlayer(self):
+        TileValueCountCache({'a': self.rasterlayer.id}, 'a', 11).set_many({(0, 0): {1: 10}})
+        self.assertEqual(TileValueCount.objects.all().count(), 1)
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            self.rasterlayer.parsestatus.reset()
+            self.rasterlayer.save()
+
+        self.assertEqual(TileValueCount.objects.all().count(), 0)
+
     def test_invalidation_changing_legend(self):
         self.assertEqual(ValueCountResult.objects.all().count(), 2)
         self.legend_exp.save()
         self.assertEqual(ValueCountResult.objects.all().count(), 0)
+
+    def test_incremental_reparse_keeps_unchanged_areas(self):
+        area_ids = set(self.agglayer.aggregationarea_set.values_list('id', flat=True))
+
+        # Reparsing the same file is skipped
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+        self.agglayer.refresh_from_db()
+        self.assertTrue('Shapefile has not changed since last parse' in self.agglayer.parse_log)
+
+        # Reparsing with changed checksum only updates changed areas
+        self.agglayer.shapefile_checksum = None
+        self.agglayer.save()
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        area.name = 'Renamed'
+        area.save()
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        new_area_ids = set(self.agglayer.aggregationarea_set.values_list('id', flat=True))
+        self.assertEqual(len(area_ids & new_area_ids), 1)
+        self.assertFalse(self.agglayer.aggregationarea_set.filter(name='Renamed').exists())
+        self.assertEqual(ValueCountResult.objects.all().count(), 1)
+
+    def test_incremental_reparse_after_settings_change(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+        area = self.agglayer.aggregationarea_set.get(name='St Petersburg')
+
+        # Changing the simplification tolerance reparses the unchanged file
+        self.agglayer.simplification_tolerance = 100
+        self.agglayer.save()
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, incremental=True)
+
+        self.agglayer.refresh_from_db()
+        self.assertFalse('Shapefile has not changed since last parse' in self.agglayer.parse_log)
+        updated = self.agglayer.aggregationarea_set.get(name='St Petersburg')
+        self.assertNotEqual(updated.geom_hash, area.geom_hash)
+        self.assertTrue(updated.geom_simplified.num_coords < area.geom_simplified.num_coords)
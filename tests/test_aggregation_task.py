@@ -1,5 +1,13 @@
-from raster_aggregation.models import ValueCountResult
-from raster_aggregation.tasks import compute_value_count_for_aggregation_layer
+from raster.valuecount import Aggregator
+
+from raster_aggregation.models import TileValueCount, ValueCountJob, ValueCountResult
+from raster_aggregation.tasks import (
+    compute_value_count_for_aggregation_layer, compute_value_count_part, fail_value_count_job, merge_value_count_parts
+)
+from raster_aggregation.utils import convert_to_multipolygon
+from raster_aggregation.valuecount import (
+    AreaAggregator, LayerAggregator, get_tile_coverage, get_tile_geometry, split_coverage
+)
 
 from .aggregation_testcase import RasterAggregationTestCase
 
@@ -9,11 +17,37 @@ class RasterAggregationTaskTests(RasterAggregationTestCase):
     def setUp(self):
         super(RasterAggregationTaskTests, self).setUp()
 
-        compute_value_count_for_aggregation_layer(self.agglayer, self.rasterlayer.id, compute_area=False)
+        compute_value_count_for_aggregation_layer(self.agglayer.id, self.rasterlayer.id, compute_area=False)
 
     def test_count_value_count_results(self):
         self.assertEqual(ValueCountResult.objects.all().count(), 2)
 
+    def test_value_count_job_progress(self):
+        job = ValueCountJob.objects.get(aggregationlayer=self.agglayer)
+        self.assertEqual(job.status, ValueCountJob.FINISHED)
+        self.assertEqual((job.total, job.done, job.failed), (2, 2, 0))
+        self.assertIsNotNone(job.finished)
+        self.assertIsNone(job.eta)
+
+    def test_value_count_job_failed_by_chunk_error(self):
+        job = ValueCountJob.objects.create(
+            aggregationlayer=self.agglayer, formula='a', layer_names={'a': str(self.rasterlayer.id)}, zoom=11, total=2,
+        )
+        job.add_progress(done=1)
+        fail_value_count_job(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ValueCountJob.FAILED)
+        self.assertIsNotNone(job.finished)
+        self.assertIsNone(job.eta)
+
+    def test_value_count_job_in_chunks(self):
+        job_id = compute_value_count_for_aggregation_layer(
+            self.agglayer.id, self.rasterlayer.id, compute_area=False, chunk_size=1,
+        )
+        job = ValueCountJob.objects.get(id=job_id)
+        self.assertEqual((job.total, job.done, job.failed), (2, 2, 0))
+        self.assertEqual(ValueCountResult.objects.all().count(), 2)
+
     def test_count_values_for_st_petersburg(self):
         result = ValueCountResult.objects.get(aggregationarea__name='St Petersburg')
         result = {k: float(v) for k, v in result.value.items()}
@@ -29,3 +63,201 @@ class RasterAggregationTaskTests(RasterAggregationTestCase):
 
         # Assert value counts are correct
         self.assertDictEqual(result, self.expected)
+
+    def test_layer_aggregator_matches_area_aggregator(self):
+        ids = {'a': str(self.rasterlayer.id)}
+        for grouping in ('auto', str(self.legend_exp.id), str(self.legend_float.id)):
+            values = LayerAggregator(self.agglayer.aggregationarea_set.all(), ids, 'a', zoom=11, grouping=grouping).value_counts()
+            for area in self.agglayer.aggregationarea_set.all():
+                agg = Aggregator(layer_dict=ids, formula='a', zoom=11, geom=area.geom, acres=True, grouping=grouping)
+                expected = {str(k): float(v) for k, v in agg.value_count().items()}
+                result = {k: float(v) for k, v in values[area.id].items()}
+                self.assertEqual(set(result.keys()), set(expected.keys()))
+                for key, val in expected.items():
+                    self.assertAlmostEqual(result[key], val)
+
+    def test_label_masks_were_built_after_parse(self):
+        self.agglayer.refresh_from_db()
+        zoom = self.rasterlayer.metadata.max_zoom
+        self.assertTrue(self.agglayer.aggregationlayerlabelmask_set.filter(tilez=zoom).exists())
+        self.assertIsNotNone(self.agglayer.get_label_masks(zoom))
+
+        # Label masks are not used after a change of the layer
+        self.agglayer.save()
+        self.assertIsNone(self.agglayer.get_label_masks(zoom))
+
+    def test_label_masks_invalidated_on_area_change(self):
+        self.agglayer.refresh_from_db()
+        area = self.agglayer.aggregationarea_set.get(name='St Petersburg')
+
+        # Saving an unchanged area keeps the masks
+        area.save()
+        self.assertIsNotNone(self.agglayer.get_label_masks(11))
+
+        area.geom = convert_to_multipolygon(area.geom.buffer(-100))
+        area.save()
+        self.assertIsNone(self.agglayer.get_label_masks(11))
+
+    def test_label_masks_limited_to_area_extent(self):
+        self.agglayer.refresh_from_db()
+        areas = self.agglayer.aggregationarea_set.filter(name='St Petersburg')
+        all_masks = list(self.agglayer.get_label_masks(11))
+        masks = list(self.agglayer.get_label_masks(11, areas))
+        self.assertTrue(0 < len(masks) <= len(all_masks))
+
+        # The limited masks give the same result for the areas
+        ids = {'a': str(self.rasterlayer.id)}
+        self.assertEqual(
+            LayerAggregator(areas, ids, 'a', zoom=11, label_masks=masks).value_counts(),
+            LayerAggregator(areas, ids, 'a', zoom=11, label_masks=all_masks).value_counts(),
+        )
+
+    def test_layer_aggregator_with_label_masks(self):
+        self.agglayer.refresh_from_db()
+        ids = {'a': str(self.rasterlayer.id)}
+        areas = self.agglayer.aggregationarea_set.all()
+        expected = LayerAggregator(areas, ids, 'a', zoom=11).value_counts()
+        result = LayerAggregator(areas, ids, 'a', zoom=11, label_masks=self.agglayer.get_label_masks(11)).value_counts()
+        self.assertEqual(result, expected)
+
+    def test_tile_coverage_was_indexed_after_parse(self):
+        zoom = self.rasterlayer.metadata.max_zoom
+        for area in self.agglayer.aggregationarea_set.all():
+            indexed = area.aggregationareatile_set.filter(zoom=zoom)
+            self.assertTrue(indexed.exists())
+            coverage = area.get_tile_coverage(zoom)
+            self.assertEqual(sorted(coverage), sorted(get_tile_coverage(area.geom, zoom)))
+            # Fully covered parent tiles are not expanded in the index
+            self.assertTrue(indexed.count() <= len(coverage))
+
+    def test_tile_coverage_rebuilt_on_area_change(self):
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        area.geom = convert_to_multipolygon(area.geom.buffer(-5000))
+        area.save()
+        self.assertTrue(area.aggregationareatile_set.filter(zoom=11).exists())
+        self.assertEqual(sorted(area.get_tile_coverage(11)), sorted(get_tile_coverage(area.geom, 11)))
+
+    def test_tile_coverage_matches_tile_range(self):
+        area = self.agglayer.aggregationarea_set.get(name='St Petersburg')
+        coverage = list(get_tile_coverage(area.geom, 11))
+        # Every tile is listed once
+        self.assertEqual(len(coverage), len(set((x, y) for x, y, covered in coverage)))
+        # Fully covered tiles are within the area
+        for tilex, tiley, covered in coverage:
+            if covered:
+                self.assertTrue(area.geom.contains(get_tile_geometry(11, tilex, tiley)))
+
+    def test_area_aggregator_matches_aggregator(self):
+        ids = {'a': str(self.rasterlayer.id)}
+        for grouping in ('auto', str(self.legend_exp.id)):
+            for area in self.agglayer.aggregationarea_set.all():
+                expected = Aggregator(layer_dict=ids, formula='a', zoom=11, geom=area.geom, acres=True, grouping=grouping)
+                expected = {str(k): float(v) for k, v in expected.value_count().items()}
+                result = AreaAggregator(
+                    area.geom, ids, 'a', zoom=11, grouping=grouping, coverage=area.get_tile_coverage(11),
+                ).value_count()
+                result = {k: float(v) for k, v in result.items()}
+                self.assertEqual(set(result.keys()), set(expected.keys()))
+                for key, val in expected.items():
+                    self.assertAlmostEqual(result[key], val)
+
+    def test_tile_histograms_are_reused(self):
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        ids = {'a': str(self.rasterlayer.id)}
+        params = dict(aggregationarea=area, formula='a', layer_names=ids, zoom=11, units='acres')
+
+        ValueCountResult.objects.create(**params)
+        fully_covered = len([tile for tile in area.get_tile_coverage(11) if tile[2]])
+        # Histograms are stored for the fully covered tiles that exist in the raster
+        self.assertTrue(0 < TileValueCount.objects.filter(tilez=11).count() <= fully_covered)
+        first = ValueCountResult.objects.get(**params).value
+
+        # A second computation uses the cached histograms
+        ValueCountResult.objects.filter(**params).delete()
+        ValueCountResult.objects.create(**params)
+        self.assertEqual(ValueCountResult.objects.get(**params).value, first)
+
+    def test_aggregators_with_and_without_prefetch(self):
+        ids = {'a': str(self.rasterlayer.id)}
+        areas = self.agglayer.aggregationarea_set.all()
+        self.assertEqual(
+            LayerAggregator(areas, ids, 'a', zoom=11, prefetch_depth=0).value_counts(),
+            LayerAggregator(areas, ids, 'a', zoom=11, prefetch_depth=3).value_counts(),
+        )
+        for area in areas:
+            self.assertEqual(
+                AreaAggregator(area.geom, ids, 'a', zoom=11, prefetch_depth=0).value_count(),
+                AreaAggregator(area.geom, ids, 'a', zoom=11, prefetch_depth=3).value_count(),
+            )
+
+    def test_area_aggregator_within_memory_budget(self):
+        ids = {'a': str(self.rasterlayer.id)}
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        agg = AreaAggregator(area.geom, ids, 'a', zoom=11, memory_budget=1)
+        self.assertEqual(agg.batch_size, 1)
+        self.assertEqual(agg.value_count(), AreaAggregator(area.geom, ids, 'a', zoom=11).value_count())
+
+    def test_aggregators_skip_tiles_outside_of_layer_extent(self):
+        ids = {'a': str(self.rasterlayer.id)}
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        agg = AreaAggregator(area.geom, ids, 'a', zoom=11, coverage=area.get_tile_coverage(11) + [(0, 0, True)])
+        self.assertFalse(agg.in_tile_range(0, 0))
+        # Tiles outside of the layer are skipped without querying the tile pyramid
+        with self.assertNumQueries(0):
+            self.assertEqual(agg.fetch_tile_data([(0, 0)]), {})
+        self.assertEqual(agg.value_count(), AreaAggregator(area.geom, ids, 'a', zoom=11).value_count())
+        # The coverage is clipped to the layer extent
+        coverage = area.get_tile_coverage(11, agg.tilerange)
+        self.assertTrue(coverage)
+        self.assertTrue(all(agg.in_tile_range(tilex, tiley) for tilex, tiley, covered in coverage))
+
+    def test_subdivided_area_matches_area_aggregator(self):
+        ids = {'a': str(self.rasterlayer.id)}
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        parts = split_coverage(area.get_tile_coverage(11), 3)
+        self.assertEqual(len(parts), 3)
+
+        counts = [compute_value_count_part(area.id, part, 'a', ids, 11) for part in parts]
+        merge_value_count_parts(counts, area.id, 'a', ids, 11, 'acres', str(self.legend_exp.id))
+
+        result = ValueCountResult.objects.get(aggregationarea=area, zoom=11, units='acres', grouping=self.legend_exp.id)
+        expected = AreaAggregator(area.geom, ids, 'a', zoom=11, grouping=str(self.legend_exp.id)).value_count()
+        self.assertEqual(set(result.value.keys()), set(expected.keys()))
+        for key, val in expected.items():
+            self.assertAlmostEqual(float(result.value[key]), val)
+
+    def test_get_or_compute_reuses_existing_result(self):
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        params = dict(aggregationarea=area, formula='a', layer_names={'a': str(self.rasterlayer.id)}, zoom=11)
+        result, created = ValueCountResult.objects.get_or_compute(units='acres', **params)
+        self.assertTrue(created)
+        again, created = ValueCountResult.objects.get_or_compute(units='acres', **params)
+        self.assertFalse(created)
+        self.assertEqual(again.id, result.id)
+
+    def test_get_or_compute_many_reuses_existing_results(self):
+        area_ids = list(self.agglayer.aggregationarea_set.values_list('id', flat=True))
+        params = dict(formula='a', layer_names={'a': str(self.rasterlayer.id)}, zoom=11, units='acres')
+        results = ValueCountResult.objects.get_or_compute_many(area_ids, **params)
+        self.assertEqual(set(results.keys()), set(area_ids))
+        again = ValueCountResult.objects.get_or_compute_many(area_ids, **params)
+        self.assertEqual(
+            {area_id: result.id for area_id, result in again.items()},
+            {area_id: result.id for area_id, result in results.items()},
+        )
+
+    def test_bulk_create_values_replaces_existing_results(self):
+        area = self.agglayer.aggregationarea_set.get(name='Coverall')
+        params = dict(formula='a', layer_names={'a': str(self.rasterlayer.id)}, zoom=11, units='acres')
+        result, created = ValueCountResult.objects.get_or_compute(area, **params)
+
+        results = ValueCountResult.objects.bulk_create_values({area.id: {'1': 2}}, **params)
+        self.assertEqual([(res.aggregationarea_id, res.value) for res in results], [(area.id, {'1': '2'})])
+        self.assertFalse(ValueCountResult.objects.filter(id=result.id).exists())
+        self.assertEqual(list(results[0].rasterlayers.all()), [self.rasterlayer])
+
+    def test_lock_key_is_independent_of_layer_order(self):
+        key = ValueCountResult.objects.get_lock_key(1, 'a+b', {'a': 1, 'b': '2'}, 11)
+        self.assertEqual(key, ValueCountResult.objects.get_lock_key(1, 'a+b', {'b': 2, 'a': '1'}, 11))
+        self.assertNotEqual(key, ValueCountResult.objects.get_lock_key(2, 'a+b', {'a': 1, 'b': 2}, 11))
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
@@ -0,0 +1,38 @@
+from unittest import skipIf
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.test import TestCase
+from raster_aggregation.utils import convert_to_multipolygon_sql, convert_to_multipolygons, shapely
+
+
+class GeometryRepairTests(TestCase):
+
+    def setUp(self):
+        self.geoms = [
+            GEOSGeometry(wkt, srid=3857) for wkt in (
+                'POLYGON((0 0, 1 0, 1 1, 0 1, 0 0))',
+                'MULTIPOLYGON(((0 0, 1 0, 1 1, 0 1, 0 0)))',
+                'POLYGON((0 0, 4 0, 4 4, 2 -2, 0 4, 0 0))',
+                'POLYGON((0 0, 1 1, 1 0, 0 1, 0 0))',
+                'GEOMETRYCOLLECTION(POLYGON((0 0, 1 0, 1 1, 0 0)), LINESTRING(0 0, 5 5))',
+                'LINESTRING(0 0, 1 1)',
+                'POINT(1 1)',
+                'POLYGON EMPTY',
+            )
+        ]
+
+    @skipIf(shapely is None, 'Shapely is not installed')
+    def test_repair_matches_sql_repair(self):
+        for geom, result in zip(self.geoms, convert_to_multipolygons(self.geoms)):
+            expected = convert_to_multipolygon_sql(geom)
+            self.assertEqual(result.geom_type, 'MultiPolygon')
+            self.assertEqual(result.srid, 3857)
+            self.assertEqual(result.empty, expected.empty)
+            if not expected.empty:
+                self.assertTrue(result.valid)
+                self.assertAlmostEqual(result.area, expected.area)
+                self.assertTrue(result.equals(expected))
+
+    def test_repair_returns_empty_geometries(self):
+        result = convert_to_multipolygons(self.geoms)
+        self.assertEqual([geom.empty for geom in result], [False, False, False, True, False, True, True, True])
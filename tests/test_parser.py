@@ -1,3 +1,13 @@
+from django.db import connection
+from raster_aggregation.models import (
+    PARSE_LOG_MAX_ITEM_ENTRIES, AggregationAreaSimplification, AggregationLayerLog, AggregationLayerLogEntry
+)
+from raster_aggregation.parser import INGEST_COPY, AggregationLayerParser
+from raster_aggregation.tasks import (
+    aggregation_layer_chunk_parser, aggregation_layer_parser, fail_aggregation_layer_parser,
+    finish_aggregation_layer_parser
+)
+
 from .aggregation_testcase import RasterAggregationTestCase
 
 
@@ -18,3 +28,146 @@ class AggregationAreaParseTests(RasterAggregationTestCase):
         self.assertTrue(
             'Finished parsing Aggregation Layer' in self.agglayer.parse_log
         )
+
+    def test_parse_log_reports_insert_rate(self):
+        self.agglayer.refresh_from_db()
+        self.assertTrue('Created 2 aggregation areas' in self.agglayer.parse_log)
+        self.assertTrue('rows/second' in self.agglayer.parse_log)
+
+    def test_bulk_insert_simplified_geometries(self):
+        for area in self.agglayer.aggregationarea_set.all():
+            geom_simplified = area.geom_simplified
+            area.simplify()
+            self.assertTrue(geom_simplified.equals_exact(area.geom_simplified))
+
+    def test_zoom_band_simplifications(self):
+        area = self.agglayer.aggregationarea_set.get(name='St Petersburg')
+        bands = AggregationAreaSimplification.objects.filter(aggregationarea=area).order_by('min_zoom')
+
+        # The bands cover all zoom levels of the layer
+        self.assertEqual(bands.first().min_zoom, self.agglayer.min_zoom_level)
+        self.assertEqual(bands.last().max_zoom, self.agglayer.max_zoom_level)
+        for band, next_band in zip(bands, bands[1:]):
+            self.assertEqual(band.max_zoom + 1, next_band.min_zoom)
+
+        # Lower zoom bands are simplified further
+        for band, next_band in zip(bands, bands[1:]):
+            self.assertTrue(band.geom.num_coords <= next_band.geom.num_coords)
+        self.assertTrue(bands.last().geom.num_coords <= area.geom.num_coords)
+
+    def test_zoom_band_simplifications_removed_on_area_save(self):
+        area = self.agglayer.aggregationarea_set.first()
+        area.save()
+        self.assertFalse(AggregationAreaSimplification.objects.filter(aggregationarea=area).exists())
+
+    def test_parse_with_small_batch_size(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            AggregationLayerParser(self.agglayer.id, batch_size=1).parse()
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+
+    def test_parse_log_entries_were_written(self):
+        entries = self.agglayer.aggregationlayerlogentry_set.all()
+        self.assertTrue(entries.filter(message__startswith='Started parsing Aggregation Layer').exists())
+        self.assertTrue(entries.filter(message__startswith='Finished parsing Aggregation Layer').exists())
+        self.assertFalse(entries.filter(level=AggregationLayerLogEntry.ERROR).exists())
+
+    def test_parse_log_is_reset_on_reparse(self):
+        self.agglayer.log('Warning: Test fid 1', level=AggregationLayerLogEntry.WARNING, fid=1)
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id)
+
+        self.agglayer.refresh_from_db()
+        entries = self.agglayer.aggregationlayerlogentry_set.all()
+        self.assertEqual(entries.filter(message__startswith='Started parsing Aggregation Layer').count(), 1)
+        self.assertFalse(entries.filter(level=AggregationLayerLogEntry.WARNING).exists())
+        self.assertEqual(self.agglayer.parse_log.count('Started parsing Aggregation Layer'), 1)
+
+    def test_parse_log_limits_item_entries(self):
+        logger = AggregationLayerLog(self.agglayer, buffer_size=10)
+        for fid in range(PARSE_LOG_MAX_ITEM_ENTRIES + 5):
+            logger.log('Warning: Test fid {0}'.format(fid), level=AggregationLayerLogEntry.WARNING, fid=fid)
+        logger.flush()
+
+        self.agglayer.refresh_from_db()
+        self.assertTrue('Started parsing Aggregation Layer' in self.agglayer.parse_log)
+        self.assertTrue('... 5 more feature and area entries omitted' in self.agglayer.parse_log)
+        self.assertEqual(
+            self.agglayer.aggregationlayerlogentry_set.filter(level=AggregationLayerLogEntry.WARNING).count(),
+            PARSE_LOG_MAX_ITEM_ENTRIES + 5
+        )
+
+    def test_parse_through_staging_table(self):
+        geoms = {area.name: area.geom for area in self.agglayer.aggregationarea_set.all()}
+
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, mode=INGEST_COPY)
+
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        for area in self.agglayer.aggregationarea_set.all():
+            self.assertTrue(area.geom.valid)
+            self.assertEqual(area.geom.geom_type, 'MultiPolygon')
+            self.assertAlmostEqual(area.geom.area, geoms[area.name].area, delta=geoms[area.name].area * 1e-6)
+            self.assertFalse(area.geom_simplified.empty)
+
+        self.agglayer.refresh_from_db()
+        self.assertTrue('Created 2 aggregation areas' in self.agglayer.parse_log)
+
+    def test_repeated_staging_ingest_in_one_transaction(self):
+        # The temporary staging tables are only dropped on commit
+        with self.settings(MEDIA_ROOT=self.media_root):
+            aggregation_layer_parser(self.agglayer.id, mode=INGEST_COPY)
+            aggregation_layer_parser(self.agglayer.id, mode=INGEST_COPY)
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+
+    def test_shapefile_is_read_in_place(self):
+        with self.settings(MEDIA_ROOT=self.media_root):
+            parser = AggregationLayerParser(self.agglayer.id)
+            parser.open_layer()
+        self.assertIsNone(parser.tmpdir)
+        self.assertTrue(parser.datasource.name.startswith('/vsizip/'))
+        self.assertEqual(parser.layer.num_feat, 2)
+        parser.close_layer()
+
+    def test_parse_in_chunks(self):
+        previous = set(self.agglayer.aggregationarea_set.values_list('id', flat=True))
+        with self.settings(MEDIA_ROOT=self.media_root):
+            parser = AggregationLayerParser(self.agglayer.id)
+            chunks = parser.prepare_chunks(chunk_size=1)
+        self.assertEqual(chunks, [(0, 1), (1, 2)])
+
+        # The shapefile is not read by the chunk tasks
+        counts = [
+            aggregation_layer_chunk_parser(self.agglayer.id, parser.staging, parser.srs, start, stop)
+            for start, stop in chunks
+        ]
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 4)
+
+        finish_aggregation_layer_parser(counts, self.agglayer.id, parser.checksum, parser.staging,
+                                        parser.previous_area_id)
+
+        self.assertEqual(counts, [1, 1])
+        self.assertEqual(self.agglayer.aggregationarea_set.count(), 2)
+        self.assertFalse(self.agglayer.aggregationarea_set.filter(id__in=previous).exists())
+        self.assertFalse(self.staging_table_exists(parser.staging))
+        self.agglayer.refresh_from_db()
+        self.assertTrue('Created 2 aggregation areas in 2 chunks' in self.agglayer.parse_log)
+
+    def test_failed_parse_in_chunks_keeps_previous_areas(self):
+        previous = set(self.agglayer.aggregationarea_set.values_list('id', flat=True))
+        with self.settings(MEDIA_ROOT=self.media_root):
+            parser = AggregationLayerParser(self.agglayer.id)
+            chunks = parser.prepare_chunks(chunk_size=1)
+
+        aggregation_layer_chunk_parser(self.agglayer.id, parser.staging, parser.srs, *chunks[0])
+        fail_aggregation_layer_parser(self.agglayer.id, parser.staging, parser.previous_area_id)
+
+        self.assertEqual(set(self.agglayer.aggregationarea_set.values_list('id', flat=True)), previous)
+        self.assertFalse(self.staging_table_exists(parser.staging))
+        self.assertTrue(
+            self.agglayer.aggregationlayerlogentry_set.filter(level=AggregationLayerLogEntry.ERROR).exists()
+        )
+
+    def staging_table_exists(self, staging):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT to_regclass(%s)', [staging])
+            return cursor.fetchone()[0] is not None
@@ -0,0 +1,61 @@
+import shutil
+import tempfile
+
+import numpy
+
+from django.test import TestCase
+from raster_aggregation.tilecache import TileCache
+
+
+class TileCacheTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.values = numpy.arange(256 * 256, dtype='uint8')
+        # Room for exactly two tiles
+        self.cache = TileCache(self.directory, max_bytes=2 * self.values.nbytes)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_tile_cache_roundtrip(self):
+        self.assertIsNone(self.cache.get(1, 11, 2, 3))
+        self.cache.set(1, 11, 2, 3, 0, self.values, 0)
+        values, nodata = self.cache.get(1, 11, 2, 3)
+        self.assertIsInstance(values, numpy.memmap)
+        self.assertTrue(numpy.array_equal(values, self.values))
+        self.assertEqual(nodata, 0)
+        self.assertEqual(self.cache.stats(), {'hits': 1, 'misses': 1, 'entries': 1, 'bytes': self.values.nbytes})
+
+    def test_tile_cache_is_shared_between_instances(self):
+        self.cache.set(1, 11, 2, 3, 0, self.values, None)
+        other = TileCache(self.directory, max_bytes=self.cache.max_bytes)
+        values, nodata = other.get(1, 11, 2, 3)
+        self.assertTrue(numpy.array_equal(values, self.values))
+        self.assertIsNone(nodata)
+
+    def test_tile_cache_evicts_least_recently_used(self):
+        self.cache.set(1, 11, 0, 0, 0, self.values, 0)
+        self.cache.set(1, 11, 0, 1, 0, self.values, 0)
+        self.cache.get(1, 11, 0, 0)
+        self.cache.set(1, 11, 0, 2, 0, self.values, 0)
+
+        self.assertIsNotNone(self.cache.get(1, 11, 0, 0))
+        self.assertIsNone(self.cache.get(1, 11, 0, 1))
+        self.assertIsNotNone(self.cache.get(1, 11, 0, 2))
+        self.assertEqual(self.cache.size, 2 * self.values.nbytes)
+
+    def test_tile_cache_invalidation(self):
+        self.cache.set(1, 11, 0, 0, 0, self.values, 0)
+        self.cache.set(2, 11, 0, 0, 0, self.values, 0)
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1, 11, 0, 0))
+        self.assertIsNotNone(self.cache.get(2, 11, 0, 0))
+
+    def test_tile_cache_versions(self):
+        self.cache.set(1, 11, 0, 0, 0, self.values, 0, version='a')
+        self.assertIsNotNone(self.cache.get(1, 11, 0, 0, version='a'))
+        # Bands of other versions of the layer are not read
+        self.assertIsNone(self.cache.get(1, 11, 0, 0, version='b'))
+        self.cache.invalidate(1)
+        self.assertIsNone(self.cache.get(1, 11, 0, 0, version='a'))